@@ -0,0 +1,518 @@
+"""Local stand-in for the r/place endpoints, for load tests without reddit.
+
+Serves everything the client talks to from one address:
+
+    GET  /login   login form with a csrf_token
+    POST /login   accepts any username with a non-empty password
+    GET  /        new.reddit.com page with the window.__r session script
+    POST /query   the setPixel mutation, with cooldown errors
+    GET  /query   websocket with the CONFIG and CANVAS subscriptions, full
+                  frames on subscribe and diff frames every --diff-interval
+    GET  /frames/ the frame images the subscriptions point to
+    GET  /stats   counters of logins, placements and rate limited requests
+
+    python -m benchmarks.fake_place --port 8080 --cooldown 5
+
+and in config.json:
+
+    "endpoints": {
+        "login": "http://127.0.0.1:8080/login",
+        "session": "http://127.0.0.1:8080/",
+        "gql": "http://127.0.0.1:8080/query",
+        "websocket": "ws://127.0.0.1:8080/query"
+    }
+"""
+
+import base64
+import hashlib
+import html
+import json
+import secrets
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs
+
+import click
+import numpy as np
+from PIL import Image
+
+from src.mappings import ColorMapper
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+CANVAS_SIZE = 1000
+# canvas index -> (dx, dy), 0 | 1 over 2 | 3 like the client lays them out
+CANVAS_OFFSETS = [(0, 0), (1000, 0), (0, 1000), (1000, 1000)]
+TOKEN_LIFETIME = 3600
+# frame images older than this many are no longer served
+FRAMES_KEPT = 256
+WHITE_INDEX = 31
+
+
+class WebSocket:
+    """Just enough of RFC 6455 for one text message at a time in each direction"""
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.lock = threading.Lock()
+
+    def read_exactly(self, length):
+        data = self.rfile.read(length)
+        if len(data) < length:
+            raise ConnectionError("Websocket closed")
+        return data
+
+    def recv(self):
+        """Next text message, None once the client closed the connection"""
+        while True:
+            first, second = self.read_exactly(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                (length,) = struct.unpack(">H", self.read_exactly(2))
+            elif length == 127:
+                (length,) = struct.unpack(">Q", self.read_exactly(8))
+            mask = self.read_exactly(4) if second & 0x80 else None
+            payload = self.read_exactly(length)
+            if mask is not None:
+                payload = (
+                    np.frombuffer(payload, np.uint8)
+                    ^ np.resize(np.frombuffer(mask, np.uint8), length)
+                ).tobytes()
+
+            if opcode == 0x8:
+                self.send_frame(0x8, b"")
+                return None
+            if opcode == 0x9:
+                self.send_frame(0xA, payload)
+            elif opcode in (0x0, 0x1):
+                return payload.decode()
+
+    def send_frame(self, opcode, payload):
+        if len(payload) < 126:
+            header = struct.pack(">BB", 0x80 | opcode, len(payload))
+        elif len(payload) < 1 << 16:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, len(payload))
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, len(payload))
+        with self.lock:
+            self.wfile.write(header + payload)
+            self.wfile.flush()
+
+    def send(self, text):
+        self.send_frame(0x1, text.encode())
+
+
+class FakePlace:
+    """Board, accounts, cooldowns and frames shared by every connection"""
+
+    def __init__(self, base_url, cooldown, diff_interval, grief_rate):
+        self.base_url = base_url
+        # In seconds
+        self.cooldown = cooldown
+        self.diff_interval = diff_interval
+        # pixels set to a random color every second, keeps the client busy
+        self.grief_rate = grief_rate
+
+        self.palette = np.asarray(
+            ColorMapper.generate_rgb_colors_array(), dtype=np.uint8
+        )
+        self.lock = threading.Lock()
+        self.board = np.full((2 * CANVAS_SIZE, 2 * CANVAS_SIZE), WHITE_INDEX, np.uint8)
+        # pixels changed since the last diff frame
+        self.changed = np.zeros(self.board.shape, dtype=bool)
+        # canvas index -> timestamp of its last frame
+        self.timestamps = [int(time.time() * 1000)] * len(CANVAS_OFFSETS)
+        # canvas index -> {websocket: subscription id}
+        self.subscribers = [{} for _ in CANVAS_OFFSETS]
+        # name -> PNG
+        self.frames = OrderedDict()
+
+        self.csrf_tokens = set()
+        # session cookie -> username
+        self.sessions = {}
+        # access token -> username
+        self.access_tokens = {}
+        # username -> timestamp in ms of the next allowed placement
+        self.next_available = {}
+        self.stats = {
+            "logins": 0,
+            "placements": 0,
+            "rate_limited": 0,
+            "websocket_connections": 0,
+        }
+        self.started_at = time.time()
+        self.rng = np.random.default_rng()
+
+    def login_page(self):
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.csrf_tokens.add(token)
+        filler = '<div class="AnimatedForm__field"><span>Username</span></div>\n' * 500
+        return (
+            "<!DOCTYPE html><html><head><title>reddit.com: Log in</title></head><body>"
+            '<form class="AnimatedForm" action="/login" method="post">'
+            '<input type="hidden" name="csrf_token" value="{}">'
+            "<input name=username><input name=password type=password></form>"
+            "{}</body></html>"
+        ).format(token, filler)
+
+    def login(self, form):
+        """Session cookie of a successful login, None otherwise"""
+        username = form.get("username", [""])[0]
+        with self.lock:
+            if form.get("csrf_token", [""])[0] not in self.csrf_tokens:
+                return None
+            self.csrf_tokens.discard(form["csrf_token"][0])
+            if not username or not form.get("password", [""])[0]:
+                return None
+            cookie = secrets.token_hex(16)
+            self.sessions[cookie] = username
+            self.stats["logins"] += 1
+        return cookie
+
+    def session_page(self, cookie):
+        with self.lock:
+            username = self.sessions.get(cookie)
+            if username is None:
+                session = {"error": "not logged in"}
+            else:
+                access_token = secrets.token_hex(16)
+                self.access_tokens[access_token] = username
+                session = {
+                    "accessToken": access_token,
+                    "expires": time.strftime(
+                        "%Y-%m-%dT%H:%M:%S.000Z",
+                        time.gmtime(time.time() + TOKEN_LIFETIME),
+                    ),
+                    "expiresIn": TOKEN_LIFETIME,
+                    "scope": "*",
+                }
+        state = {"user": {"account": {"displayText": username}, "session": session}}
+        filler = '<div class="Post"><a href="/r/place/">r/place</a></div>\n' * 500
+        return (
+            "<!DOCTYPE html><html><head><title>reddit</title></head><body>"
+            '<script id="data">window.__r = {};</script>{}</body></html>'
+        ).format(json.dumps(state), filler)
+
+    def set_pixel(self, authorization, body):
+        access_token = authorization[len("Bearer ") :]
+        coordinate = body["variables"]["input"]["PixelMessageData"]
+        now = int(time.time() * 1000)
+        with self.lock:
+            username = self.access_tokens.get(access_token)
+            if username is None:
+                return {"errors": [{"message": "Unauthorized"}], "data": None}
+            next_available = self.next_available.get(username, 0)
+            if next_available > now:
+                self.stats["rate_limited"] += 1
+                return {
+                    "errors": [
+                        {
+                            "message": "Ratelimited",
+                            "extensions": {"nextAvailablePixelTs": next_available},
+                        }
+                    ],
+                    "data": None,
+                }
+
+            dx, dy = CANVAS_OFFSETS[coordinate["canvasIndex"]]
+            x = dx + coordinate["coordinate"]["x"]
+            y = dy + coordinate["coordinate"]["y"]
+            self.board[y, x] = coordinate["colorIndex"]
+            self.changed[y, x] = True
+            next_available = now + int(self.cooldown * 1000)
+            self.next_available[username] = next_available
+            self.stats["placements"] += 1
+
+        return {
+            "data": {
+                "act": {
+                    "data": [
+                        {
+                            "data": {
+                                "nextAvailablePixelTimestamp": next_available,
+                                "__typename": "GetUserCooldownResponseMessageData",
+                            }
+                        },
+                        {
+                            "data": {
+                                "timestamp": now,
+                                "__typename": "SetPixelResponseMessageData",
+                            }
+                        },
+                    ]
+                }
+            }
+        }
+
+    def store_frame(self, name, rgba):
+        buffer = BytesIO()
+        Image.fromarray(rgba).save(buffer, format="PNG", compress_level=1)
+        self.frames[name] = buffer.getvalue()
+        while len(self.frames) > FRAMES_KEPT:
+            self.frames.popitem(last=False)
+        return "{}/frames/{}".format(self.base_url, name)
+
+    def canvas_slice(self, canvas_index):
+        dx, dy = CANVAS_OFFSETS[canvas_index]
+        return slice(dy, dy + CANVAS_SIZE), slice(dx, dx + CANVAS_SIZE)
+
+    def full_frame(self, canvas_index):
+        """FullFrameMessageData of the current state, called with the lock held"""
+        timestamp = self.timestamps[canvas_index]
+        name = "full-{}-{}.png".format(canvas_index, timestamp)
+        url = "{}/frames/{}".format(self.base_url, name)
+        if name not in self.frames:
+            indices = self.board[self.canvas_slice(canvas_index)]
+            rgba = np.full(indices.shape + (4,), 255, dtype=np.uint8)
+            rgba[..., :3] = self.palette[indices]
+            url = self.store_frame(name, rgba)
+        return {
+            "__typename": "FullFrameMessageData",
+            "name": url,
+            "timestamp": timestamp,
+        }
+
+    def config(self):
+        return {
+            "__typename": "ConfigurationMessageData",
+            "colorPalette": {
+                "colors": [
+                    {"hex": color_hex, "index": index}
+                    for color_hex, index in ColorMapper.COLOR_MAP.items()
+                ]
+            },
+            "canvasConfigurations": [
+                {"index": index, "dx": dx, "dy": dy}
+                for index, (dx, dy) in enumerate(CANVAS_OFFSETS)
+            ],
+            "canvasWidth": CANVAS_SIZE,
+            "canvasHeight": CANVAS_SIZE,
+        }
+
+    @staticmethod
+    def data_message(subscription_id, data):
+        return json.dumps(
+            {
+                "type": "data",
+                "id": subscription_id,
+                "payload": {"data": {"subscribe": {"data": data}}},
+            }
+        )
+
+    def serve_websocket(self, ws):
+        with self.lock:
+            self.stats["websocket_connections"] += 1
+        try:
+            while True:
+                text = ws.recv()
+                if text is None:
+                    return
+                message = json.loads(text)
+                if message["type"] == "connection_init":
+                    ws.send('{"type":"connection_ack"}')
+                elif message["type"] == "start":
+                    self.start_subscription(ws, message)
+                elif message["type"] == "stop":
+                    with self.lock:
+                        for subscribers in self.subscribers:
+                            if subscribers.get(ws) == message["id"]:
+                                del subscribers[ws]
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.lock:
+                for subscribers in self.subscribers:
+                    subscribers.pop(ws, None)
+
+    def start_subscription(self, ws, message):
+        channel = message["payload"]["variables"]["input"]["channel"]
+        if channel["category"] == "CONFIG":
+            ws.send(self.data_message(message["id"], self.config()))
+            return
+
+        canvas_index = int(channel["tag"])
+        with self.lock:
+            self.subscribers[canvas_index][ws] = message["id"]
+            frame = self.full_frame(canvas_index)
+        ws.send(self.data_message(message["id"], frame))
+
+    def grief(self, count):
+        ys = self.rng.integers(0, self.board.shape[0], count)
+        xs = self.rng.integers(0, self.board.shape[1], count)
+        self.board[ys, xs] = self.rng.integers(0, len(self.palette), count)
+        self.changed[ys, xs] = True
+
+    def run_diffs(self):
+        """Publish a diff frame for every canvas that changed, forever"""
+        while True:
+            time.sleep(self.diff_interval)
+            messages = []
+            with self.lock:
+                self.grief(int(self.grief_rate * self.diff_interval))
+                for canvas_index in range(len(CANVAS_OFFSETS)):
+                    region = self.canvas_slice(canvas_index)
+                    changed = self.changed[region]
+                    if not changed.any():
+                        continue
+                    rgba = np.zeros((CANVAS_SIZE, CANVAS_SIZE, 4), dtype=np.uint8)
+                    rgba[changed, :3] = self.palette[self.board[region][changed]]
+                    rgba[changed, 3] = 255
+                    changed[...] = False
+
+                    previous = self.timestamps[canvas_index]
+                    current = max(int(time.time() * 1000), previous + 1)
+                    self.timestamps[canvas_index] = current
+                    name = "diff-{}-{}.png".format(canvas_index, current)
+                    data = {
+                        "__typename": "DiffFrameMessageData",
+                        "name": self.store_frame(name, rgba),
+                        "currentTimestamp": current,
+                        "previousTimestamp": previous,
+                    }
+                    messages += [
+                        (ws, self.data_message(subscription_id, data))
+                        for ws, subscription_id in self.subscribers[
+                            canvas_index
+                        ].items()
+                    ]
+
+            for ws, text in messages:
+                try:
+                    ws.send(text)
+                except OSError:
+                    pass
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, "uptime": time.time() - self.started_at}
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive, the client reuses its connections
+    protocol_version = "HTTP/1.1"
+    place = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body, content_type="text/html", headers=()):
+        body = body if isinstance(body, bytes) else body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def cookie(self):
+        cookies = SimpleCookie(self.headers.get("Cookie", ""))
+        return cookies["session"].value if "session" in cookies else None
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if self.headers.get("Upgrade", "").lower() == "websocket":
+            self.upgrade()
+        elif path == "/login":
+            self.respond(200, self.place.login_page())
+        elif path == "/":
+            self.respond(200, self.place.session_page(self.cookie()))
+        elif path.startswith("/frames/"):
+            frame = self.place.frames.get(path[len("/frames/") :])
+            if frame is None:
+                self.respond(404, "frame expired")
+            else:
+                self.respond(200, frame, "image/png")
+        elif path == "/stats":
+            self.respond(200, json.dumps(self.place.get_stats()), "application/json")
+        else:
+            self.respond(404, "not found")
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if path == "/login":
+            cookie = self.place.login(parse_qs(body.decode()))
+            if cookie is None:
+                self.respond(400, html.escape("wrong username or password"))
+            else:
+                self.respond(
+                    200, "{}", "application/json", [("Set-Cookie", "session=" + cookie)]
+                )
+        elif path == "/query":
+            response = self.place.set_pixel(
+                self.headers.get("Authorization", ""), json.loads(body)
+            )
+            self.respond(200, json.dumps(response), "application/json")
+        else:
+            self.respond(404, "not found")
+
+    def upgrade(self):
+        accept = base64.b64encode(
+            hashlib.sha1(
+                (self.headers["Sec-WebSocket-Key"] + WEBSOCKET_GUID).encode()
+            ).digest()
+        ).decode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+        self.place.serve_websocket(WebSocket(self.rfile, self.wfile))
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # a thousand accounts connect at once
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # clients hanging up on keep-alive connections are not worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(host, port, cooldown, diff_interval, grief_rate):
+    """Start the server in background threads and return it"""
+    server = Server((host, port), Handler)
+    place = FakePlace(
+        "http://{}:{}".format(host, server.server_address[1]),
+        cooldown,
+        diff_interval,
+        grief_rate,
+    )
+    server.RequestHandlerClass = type("BoundHandler", (Handler,), {"place": place})
+    threading.Thread(target=place.run_diffs, daemon=True).start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, place
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8080, help="0 picks a free port")
+@click.option("--cooldown", default=5.0, help="Seconds between placements")
+@click.option("--diff-interval", default=1.0, help="Seconds between diff frames")
+@click.option("--grief-rate", default=0.0, help="Random pixels changed per second")
+def main(host, port, cooldown, diff_interval, grief_rate):
+    server, place = serve(host, port, cooldown, diff_interval, grief_rate)
+    click.echo("Serving on {}".format(place.base_url))
+    try:
+        while True:
+            time.sleep(10)
+            click.echo(json.dumps(place.get_stats()))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""Time the palette mapping, diff and board stitching hot paths.
+
+Synthetic templates and boards of every --size are used, from a small
+artwork up to the full 2000x2000 board. Results are written as JSON so two
+runs can be compared:
+
+    nox -s benchmarks -- --output before.json
+    nox -s benchmarks -- --output after.json --compare before.json
+
+With --compare the exit status is 1 when a benchmark got slower than
+--threshold times its previous median.
+"""
+
+import json
+import platform
+import statistics
+import sys
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+import click
+import numpy as np
+from loguru import logger
+from PIL import Image
+
+from src.board import BoardMirror
+from src.heatmap import OverwriteHeatmap
+from src.mappings import ColorMapper
+from src.scheduler import PixelScheduler
+import src.diff as diff
+import src.quantize as quantize
+import src.template as template
+
+DEFAULT_SIZES = (100, 500, 1000, 2000)
+# share of template pixels that are wrong on the synthetic board
+WRONG_RATIO = 0.05
+# share of canvas pixels changed by a synthetic diff frame
+DIFF_FRAME_RATIO = 0.01
+CLAIMS = 1000
+
+
+class DiscardingSocket:
+    """Stands in for the websocket when the mirror is fed frames directly"""
+
+    def send(self, payload):
+        pass
+
+
+def synthetic_template(rng, size, palette):
+    indices = rng.integers(0, len(palette), (size, size), dtype=np.uint8)
+    indices[rng.random((size, size)) < 0.1] = ColorMapper.TRANSPARENT_INDEX
+    return indices
+
+
+def synthetic_board(rng, indices, palette):
+    board = np.where(indices == ColorMapper.TRANSPARENT_INDEX, 0, indices)
+    wrong = rng.random(indices.shape) < WRONG_RATIO
+    board[wrong] = (board[wrong] + 1) % len(palette)
+    return board.astype(np.uint8)
+
+
+def synthetic_image(rng, size):
+    rgba = rng.integers(0, 256, (size, size, 4), dtype=np.uint8)
+    rgba[..., 3] = 255
+    return Image.fromarray(rgba)
+
+
+def frame_png(rgba):
+    buffer = BytesIO()
+    Image.fromarray(rgba).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def make_client(indices, palette):
+    client = SimpleNamespace(
+        logger=logger,
+        debug=False,
+        rgb_colors_array=palette,
+        pixel_x_start=0,
+        pixel_y_start=0,
+        image_size=(indices.shape[1], indices.shape[0]),
+        template_indices=indices,
+        template_priority=np.zeros(indices.shape, dtype=np.uint16),
+        template_order=template.repair_order(
+            indices, np.zeros(indices.shape, dtype=np.uint16)
+        ),
+    )
+    client.heatmap = OverwriteHeatmap(client)
+    return client
+
+
+def make_mirror(client, size):
+    """Board mirror of a size x size board made of four canvases"""
+    canvas_size = -(-size // 2)
+    mirror = BoardMirror(client)
+    mirror.apply_config(
+        DiscardingSocket(),
+        {
+            "canvasConfigurations": [
+                {"index": i, "dx": canvas_size * (i % 2), "dy": canvas_size * (i // 2)}
+                for i in range(4)
+            ],
+            "canvasWidth": canvas_size,
+            "canvasHeight": canvas_size,
+        },
+    )
+    return mirror, canvas_size
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(1000 * (time.perf_counter() - start))
+    return {
+        "median_ms": statistics.median(times),
+        "min_ms": min(times),
+        "repeat": repeat,
+    }
+
+
+def benchmarks(rng, size, palette, lut):
+    """(name, function) pairs for one size, setup happens here and is not timed"""
+    image = synthetic_image(rng, size)
+    indices = synthetic_template(rng, size, palette)
+    board = synthetic_board(rng, indices, palette)
+
+    client = make_client(indices, palette)
+    client.get_board = lambda thread_index=None: board
+    scheduler = PixelScheduler(client)
+
+    def claim():
+        # every run starts without the leases of the previous one
+        scheduler.leases = {}
+        scheduler.refresh(time.time(), board)
+        for _ in range(min(CLAIMS, len(scheduler.pending))):
+            scheduler.try_claim(0)
+
+    mirror, canvas_size = make_mirror(client, size)
+    palette_array = np.asarray(palette, dtype=np.uint8)
+    frames = []
+    for i in range(4):
+        colors = rng.integers(0, len(palette), (canvas_size, canvas_size))
+        rgba = np.empty((canvas_size, canvas_size, 4), dtype=np.uint8)
+        rgba[..., :3] = palette_array[colors]
+        rgba[..., 3] = 255
+        frames.append(frame_png(rgba))
+    diff_rgba = np.zeros((canvas_size, canvas_size, 4), dtype=np.uint8)
+    changed = rng.random((canvas_size, canvas_size)) < DIFF_FRAME_RATIO
+    diff_rgba[changed, :3] = palette_array[
+        rng.integers(0, len(palette), int(changed.sum()))
+    ]
+    diff_rgba[changed, 3] = 255
+    diff_frame = frame_png(diff_rgba)
+
+    def stitch():
+        for i, body in enumerate(frames):
+            mirror.paste_frame(i, mirror.decode_frame(body), False)
+
+    return [
+        (
+            "quantize-nearest",
+            lambda: quantize.quantize(image, palette, True, "nearest", lut),
+        ),
+        (
+            "quantize-ordered",
+            lambda: quantize.quantize(image, palette, True, "ordered", lut),
+        ),
+        ("diff-board", lambda: diff.diff_board(board, indices, (0, 0))),
+        ("claim-{}".format(CLAIMS), claim),
+        ("decode-frame", lambda: mirror.decode_frame(frames[0])),
+        ("stitch-full-frames", stitch),
+        (
+            "apply-diff-frame",
+            lambda: mirror.paste_frame(0, mirror.decode_frame(diff_frame), True),
+        ),
+    ]
+
+
+def compare(results, previous, threshold):
+    """Print the change against an earlier run, True if nothing regressed"""
+    ok = True
+    for key, result in results.items():
+        if key not in previous:
+            continue
+        ratio = result["median_ms"] / previous[key]["median_ms"]
+        regressed = ratio > threshold
+        ok = ok and not regressed
+        click.echo(
+            "{:<32} {:>10.2f} ms -> {:>10.2f} ms  {:>5.2f}x{}".format(
+                key,
+                previous[key]["median_ms"],
+                result["median_ms"],
+                ratio,
+                "  REGRESSION" if regressed else "",
+            )
+        )
+    return ok
+
+
+@click.command()
+@click.option(
+    "-s",
+    "--size",
+    "sizes",
+    type=int,
+    multiple=True,
+    help="Template and board edge length, repeatable (default 100 500 1000 2000)",
+)
+@click.option("-r", "--repeat", default=5, help="Runs per benchmark")
+@click.option(
+    "-o",
+    "--output",
+    default="benchmark_results.json",
+    help="Where to write the results",
+)
+@click.option(
+    "--compare",
+    "compare_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Results of an earlier run to compare against",
+)
+@click.option(
+    "--threshold",
+    default=1.2,
+    help="Slowdown of the median that counts as a regression",
+)
+def main(sizes, repeat, output, compare_path, threshold):
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    rng = np.random.default_rng(0)
+    palette = ColorMapper.generate_rgb_colors_array()
+    lut = ColorMapper.load_lut(palette, "rgb", None)
+
+    results = {}
+    for size in sizes or DEFAULT_SIZES:
+        for name, func in benchmarks(rng, size, palette, lut):
+            key = "{}/{}".format(name, size)
+            results[key] = measure(func, repeat)
+            click.echo(
+                "{:<32} median {:>10.2f} ms  min {:>10.2f} ms".format(
+                    key, results[key]["median_ms"], results[key]["min_ms"]
+                )
+            )
+
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    click.echo("Results written to {}".format(output))
+
+    if compare_path is not None:
+        with open(compare_path) as f:
+            previous = json.load(f)["results"]
+        if not compare(results, previous, threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Drive the client with many accounts against benchmarks/fake_place.py.
+
+The fake server runs in its own process so the CPU time and memory reported
+are the client's alone. Every account logs in, mirrors the board and places
+pixels of a random template until --duration runs out; the server paints
+over --grief-rate random pixels per second so there is always work left.
+
+    python -m benchmarks.load_test --accounts 1000 --duration 60 --cooldown 5
+"""
+
+import json
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import click
+import numpy as np
+import requests
+from loguru import logger
+from PIL import Image
+
+from main import PlaceClient
+from src.engine import AsyncEngine
+from src.mappings import ColorMapper
+import src.transport as transport
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, cooldown, grief_rate):
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.fake_place",
+            "--port",
+            str(port),
+            "--cooldown",
+            str(cooldown),
+            "--grief-rate",
+            str(grief_rate),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    stats_url = "http://127.0.0.1:{}/stats".format(port)
+    for _ in range(100):
+        try:
+            requests.get(stats_url)
+            return server, stats_url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise click.ClickException("Fake server did not start")
+
+
+def write_config(directory, port, accounts, template_size):
+    rng = np.random.default_rng(0)
+    palette = np.asarray(ColorMapper.generate_rgb_colors_array(), dtype=np.uint8)
+    image_path = os.path.join(directory, "template.png")
+    Image.fromarray(
+        palette[rng.integers(0, len(palette), (template_size, template_size))]
+    ).save(image_path)
+
+    base_url = "http://127.0.0.1:{}".format(port)
+    config_path = os.path.join(directory, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(
+            {
+                "image_path": image_path,
+                "image_start_coords": [900, 900],
+                "thread_delay": 0,
+                "compact_logging": True,
+                "token_cache_path": None,
+                "token_refresh_workers": 32,
+                "template_reload_interval": None,
+                "cache_dir": None,
+                "endpoints": {
+                    "login": base_url + "/login",
+                    "session": base_url + "/",
+                    "gql": base_url + "/query",
+                    "websocket": "ws://127.0.0.1:{}/query".format(port),
+                },
+                "workers": {
+                    "account{}".format(i): {"password": "password"}
+                    for i in range(accounts)
+                },
+            },
+            f,
+        )
+    return config_path
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+@click.command()
+@click.option("-a", "--accounts", default=1000, help="Simulated accounts")
+@click.option("-d", "--duration", default=60.0, help="Seconds to measure")
+@click.option("--cooldown", default=5.0, help="Seconds between placements")
+@click.option("--template-size", default=200, help="Edge length of the template")
+@click.option("--grief-rate", default=200.0, help="Pixels painted over per second")
+@click.option(
+    "-e",
+    "--engine",
+    type=click.Choice(["threads", "async"]),
+    default="threads",
+)
+@click.option("--concurrency", default=32, help="Requests in flight, async engine")
+@click.option("-o", "--output", help="Also write the results to this JSON file")
+@click.option("--debug", is_flag=True, help="Show the client's log")
+def main(
+    accounts,
+    duration,
+    cooldown,
+    template_size,
+    grief_rate,
+    engine,
+    concurrency,
+    output,
+    debug,
+):
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG" if debug else "CRITICAL")
+
+    port = free_port()
+    server, stats_url = start_server(port, cooldown, grief_rate)
+    directory = tempfile.mkdtemp()
+    try:
+        client = PlaceClient(
+            write_config(directory, port, accounts, template_size), debug=debug
+        )
+
+        # every setPixel round trip, list.append is atomic
+        latencies = []
+        set_pixel = transport.set_pixel
+
+        def timed_set_pixel(*args):
+            start = time.perf_counter()
+            try:
+                return set_pixel(*args)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        transport.set_pixel = timed_set_pixel
+
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        if engine == "async":
+            target = AsyncEngine(client, concurrency).start
+        else:
+            target = client.start
+        threading.Thread(target=target, daemon=True).start()
+        time.sleep(duration)
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        stats = requests.get(stats_url).json()
+        latencies = sorted(latencies)
+        results = {
+            "accounts": accounts,
+            "engine": engine,
+            "duration": duration,
+            "cooldown": cooldown,
+            "logins": stats["logins"],
+            "placements": stats["placements"],
+            "rate_limited": stats["rate_limited"],
+            "pixels_per_second": stats["placements"] / duration,
+            "latency_ms": (
+                {
+                    "p50": 1000 * percentile(latencies, 0.5),
+                    "p90": 1000 * percentile(latencies, 0.9),
+                    "p99": 1000 * percentile(latencies, 0.99),
+                    "max": 1000 * latencies[-1],
+                    "mean": 1000 * statistics.mean(latencies),
+                }
+                if latencies
+                else None
+            ),
+            "cpu_seconds": (usage.ru_utime - usage_before.ru_utime)
+            + (usage.ru_stime - usage_before.ru_stime),
+            "max_rss_mib": usage.ru_maxrss / 1024,
+            "threads": threading.active_count(),
+            "template_completion": client.scheduler.completion,
+        }
+        click.echo(json.dumps(results, indent=2))
+        if output is not None:
+            with open(output, "w") as f:
+                json.dump(results, f, indent=2)
+    finally:
+        server.terminate()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # worker pools never finish on their own
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Compare streaming token extraction with the full BeautifulSoup parse.
+
+Save real pages with your browser (reddit.com/login and new.reddit.com while
+logged in) and pass them with --login-page / --session-page. Without them,
+synthetic pages with the same layout and a similar size are used.
+
+    python -m benchmarks.token_extraction --session-page new_reddit.html
+"""
+
+import json
+import timeit
+
+import click
+from bs4 import BeautifulSoup
+
+import src.auth as auth
+
+
+def synthetic_login_page():
+    filler = '<div class="AnimatedForm__field"><span>Username</span></div>\n' * 2000
+    return (
+        "<!DOCTYPE html><html><head><title>reddit.com: Log in</title></head><body>"
+        '<form class="AnimatedForm" action="/login" method="post">'
+        '<input type="hidden" name="csrf_token" value="0123456789abcdef0123456789abcdef">'
+        "<input name=username><input name=password type=password></form>"
+        + filler
+        + "</body></html>"
+    ).encode()
+
+
+def synthetic_session_page():
+    state = {
+        "user": {
+            "account": {"id": "t2_example", "displayText": "example"},
+            "session": {
+                "accessToken": "12345678-abcdefghijklmnopqrstuvwxyz",
+                "expires": "2022-04-04T12:00:00.000Z",
+                "expiresIn": 3600,
+                "scope": "*",
+            },
+        },
+        "posts": {
+            "models": {
+                "t3_%d" % i: {"title": "Post %d" % i, "score": i} for i in range(5000)
+            }
+        },
+    }
+    filler = '<div class="Post"><a href="/r/place/">r/place</a></div>\n' * 5000
+    return (
+        "<!DOCTYPE html><html><head><title>reddit</title></head><body>"
+        '<div id="2x-container"></div>'
+        '<script id="data">window.__r = '
+        + json.dumps(state)
+        + ";</script>"
+        + filler
+        + "</body></html>"
+    ).encode()
+
+
+def chunked(page):
+    return (page[i : i + auth.CHUNK_SIZE] for i in range(0, len(page), auth.CHUNK_SIZE))
+
+
+def soup_csrf_token(page):
+    return BeautifulSoup(page, "html.parser").find("input", {"name": "csrf_token"})[
+        "value"
+    ]
+
+
+def soup_session(page):
+    data_str = (
+        BeautifulSoup(page, features="html.parser")
+        .find("script", {"id": "data"})
+        .contents[0][len("window.__r = ") : -1]
+    )
+    return json.loads(data_str)["user"]["session"]
+
+
+def compare(label, page, streaming, soup, number):
+    assert streaming(chunked(page)) == soup(page), "extractors disagree"
+    streaming_time = timeit.timeit(lambda: streaming(chunked(page)), number=number)
+    soup_time = timeit.timeit(lambda: soup(page), number=number)
+    click.echo(
+        "{}: {} KiB, streaming {:.2f} ms, BeautifulSoup {:.2f} ms ({:.0f}x)".format(
+            label,
+            len(page) // 1024,
+            1000 * streaming_time / number,
+            1000 * soup_time / number,
+            soup_time / streaming_time,
+        )
+    )
+
+
+@click.command()
+@click.option("--login-page", type=click.File("rb"), help="Saved reddit.com/login")
+@click.option("--session-page", type=click.File("rb"), help="Saved new.reddit.com")
+@click.option("-n", "--number", default=20, help="Runs per extractor")
+def main(login_page, session_page, number):
+    compare(
+        "csrf_token",
+        login_page.read() if login_page else synthetic_login_page(),
+        auth.extract_csrf_token,
+        soup_csrf_token,
+        number,
+    )
+    compare(
+        "session",
+        session_page.read() if session_page else synthetic_session_page(),
+        auth.extract_session,
+        soup_session,
+        number,
+    )
+
+
+if __name__ == "__main__":
+    main()
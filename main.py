@@ -1,32 +1,44 @@
 import math
+import signal
 
 import requests
-import json
 import time
-import threading
 import sys
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus
-from websocket import create_connection
-from PIL import Image
 
 from loguru import logger
 import click
-from bs4 import BeautifulSoup
 
 
+from src.board import BoardMirror
+from src.engine import AsyncEngine
+from src.heatmap import OverwriteHeatmap
+from src.journal import EventJournal
 from src.mappings import ColorMapper
+from src.metrics import Metrics
+from src.profiler import Profiler
+from src.reload import TemplateWatcher
+from src.scheduler import PixelScheduler
+from src.timer import CooldownTimer
+import src.auth as auth
 import src.proxy as proxy
+import src.transport as transport
 import src.utils as utils
 
+# In seconds, unverified accounts may place a pixel every 20 minutes
+UNVERIFIED_PLACE_FREQUENCY = 1230
+
 
 class PlaceClient:
-    def __init__(self, config_path):
+    def __init__(self, config_path, offline=False, debug=False):
         self.logger = logger
+        # Whether DEBUG messages are shown, decided once so hot paths skip
+        # building messages that would be dropped
+        self.debug = debug
         # Data
+        self.config_path = config_path
         self.json_data = utils.get_json_data(self, config_path)
-        self.pixel_x_start: int = self.json_data["image_start_coords"][0]
-        self.pixel_y_start: int = self.json_data["image_start_coords"][1]
 
         # In seconds
         self.delay_between_launches = (
@@ -42,35 +54,95 @@ class PlaceClient:
             else False
         )
 
-        self.legacy_transparency = (
-            self.json_data["legacy_transparency"]
-            if "legacy_transparency" in self.json_data
-            and self.json_data["legacy_transparency"] is not None
-            else True
-        )
-        proxy.Init(self)
+        self.endpoints = transport.get_endpoints(self.json_data)
+        if offline:
+            # nothing is sent, e.g. when only compiling the template
+            self.proxies = None
+            self.using_tor = False
+            self.compactlogging = True
+        else:
+            proxy.Init(self)
 
         # Color palette
         self.rgb_colors_array = ColorMapper.generate_rgb_colors_array()
+        # How the images become templates, reloaded together with them
+        utils.set_template_settings(self, utils.get_template_settings(self.json_data))
+        # Lookup tables and other derived data reused between runs
+        self.cache_dir = (
+            self.json_data["cache_dir"] if "cache_dir" in self.json_data else ".cache"
+        )
 
         # Auth
         self.access_tokens = {}
         self.access_token_expires_at_timestamp = {}
+        self.token_cache_path = (
+            self.json_data["token_cache_path"]
+            if "token_cache_path" in self.json_data
+            else "token_cache.json"
+        )
+        auth.load_token_cache(self)
+        self.token_refresher = auth.TokenRefresher(
+            self,
+            (
+                self.json_data["token_refresh_workers"]
+                if "token_refresh_workers" in self.json_data
+                and self.json_data["token_refresh_workers"] is not None
+                else 4
+            ),
+        )
 
         # Image information
-        self.pix = None
+        # Top left corner of all templates together, set by load_image
+        self.pixel_x_start = None
+        self.pixel_y_start = None
+        self.template_indices = None
+        # Priority of the template every pixel comes from
+        self.template_priority = None
         self.image_size = None
-        self.image_path = (
-            self.json_data["image_path"]
-            if "image_path" in self.json_data
-            else "image.jpg"
+        self.template_specs = utils.get_template_specs(self.json_data)
+        # Written by the compile command, loaded instead of the images if present
+        self.compiled_template_path = (
+            self.json_data["compiled_template"]
+            if "compiled_template" in self.json_data
+            else None
         )
-        self.first_run_counter = 0
+        # Drawable positions, most important first
+        self.template_order = None
+        if offline:
+            return
 
         # Initialize-functions
         utils.load_image(self)
 
-        self.waiting_thread_index = -1
+        # Board
+        self.heatmap = OverwriteHeatmap(
+            self,
+            (
+                self.json_data["heatmap_half_life"]
+                if "heatmap_half_life" in self.json_data
+                and self.json_data["heatmap_half_life"] is not None
+                else 600
+            ),
+        )
+        self.board_mirror = BoardMirror(self)
+        self.scheduler = PixelScheduler(self)
+        self.template_watcher = TemplateWatcher(
+            self,
+            (
+                self.json_data["template_reload_interval"]
+                if "template_reload_interval" in self.json_data
+                else 5
+            ),
+        )
+
+        # Workers
+        self.cooldowns = CooldownTimer()
+
+        self.metrics = Metrics(self)
+        # enabled with --profile
+        self.profiler = Profiler(self)
+        # sized with --journal
+        self.journal = EventJournal(self)
 
     """ Main """
     # Draw a pixel at an x, y coordinate in r/place with a specific color
@@ -97,52 +169,31 @@ class PlaceClient:
             y + (1000 * (canvas_index // 2)),
         )
 
-        url = "https://gql-realtime-2.reddit.com/query"
-
-        payload = json.dumps(
-            {
-                "operationName": "setPixel",
-                "variables": {
-                    "input": {
-                        "actionName": "r/replace:set_pixel",
-                        "PixelMessageData": {
-                            "coordinate": {"x": x, "y": y},
-                            "colorIndex": color_index_in,
-                            "canvasIndex": canvas_index,
-                        },
-                    }
-                },
-                "query": "mutation setPixel($input: ActInput!) {\n  act(input: $input) {\n    data {\n      ... on BasicMessage {\n        id\n        data {\n          ... on GetUserCooldownResponseMessageData {\n            nextAvailablePixelTimestamp\n            __typename\n          }\n          ... on SetPixelResponseMessageData {\n            timestamp\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
-            }
-        )
-        headers = {
-            "origin": "https://hot-potato.reddit.com",
-            "referer": "https://hot-potato.reddit.com/",
-            "apollographql-client-name": "mona-lisa",
-            "Authorization": "Bearer " + access_token_in,
-            "Content-Type": "application/json",
-        }
-
-        response = requests.request(
-            "POST",
-            url,
-            headers=headers,
-            data=payload,
-            proxies=proxy.get_random_proxy(self),
-        )
-        logger.debug(
-            "Thread #{} - {}: Received response: {}", thread_index, name, response.text
-        )
-
-        self.waiting_thread_index = -1
+        with self.metrics.set_pixel_seconds.time():
+            response, body = transport.set_pixel(
+                self, access_token_in, x, y, color_index_in, canvas_index
+            )
+        if self.debug:
+            logger.debug(
+                "Thread #{} - {}: Received response: {}",
+                thread_index,
+                name,
+                response.text,
+            )
 
         # There are 2 different JSON keys for responses to get the next timestamp.
         # If we don't get data, it means we've been rate limited.
         # If we do, a pixel has been successfully placed.
-        if response.json()["data"] is None:
-            logger.debug(response.json().get("errors"))
+        placed = body["data"] is not None
+        self.journal.record(
+            "place", thread_index, x, y, canvas_index, color_index_in, placed
+        )
+        if not placed:
+            self.metrics.rate_limited.inc()
+            if self.debug:
+                logger.debug(body.get("errors"))
             waitTime = math.floor(
-                response.json()["errors"][0]["extensions"]["nextAvailablePixelTs"]
+                body["errors"][0]["extensions"]["nextAvailablePixelTs"]
             )
             logger.error(
                 "Thread #{} - {}: Failed placing pixel: rate limited",
@@ -150,10 +201,9 @@ class PlaceClient:
                 name,
             )
         else:
+            self.metrics.placements.inc()
             waitTime = math.floor(
-                response.json()["data"]["act"]["data"][0]["data"][
-                    "nextAvailablePixelTimestamp"
-                ]
+                body["data"]["act"]["data"][0]["data"]["nextAvailablePixelTimestamp"]
             )
             logger.success(
                 "Thread #{} - {}: Succeeded placing pixel", thread_index, name
@@ -165,15 +215,85 @@ class PlaceClient:
         # Move the code anywhere you want, I put it here to inspect the API responses.
 
         # Reddit returns time in ms and we need seconds, so divide by 1000
-        return waitTime / 1000
+        return waitTime / 1000, placed
+
+    # Palette indices of the board under the template
+    def get_board(self, thread_index=None):
+        # The mirror keeps a single subscription open for all workers
+        self.board_mirror.start()
+        with self.profiler.span(
+            "get_board", thread_index
+        ), self.metrics.get_board_seconds.time():
+            return self.board_mirror.get_region(
+                self.pixel_x_start,
+                self.pixel_y_start,
+                self.image_size[0],
+                self.image_size[1],
+            )
+
+    def get_unset_pixel(self, index):
+        # The scheduler leases the most important wrong pixel to a single worker
+        with self.profiler.span("get_unset_pixel", index):
+            x, y, color_index = self.scheduler.claim(index)
+        self.journal.record(
+            "claim", index, x + self.pixel_x_start, y + self.pixel_y_start, color_index
+        )
+        if self.debug:
+            logger.debug(
+                "Thread #{} : Replacing pixel at: {},{} with {} color",
+                index,
+                x + self.pixel_x_start,
+                y + self.pixel_y_start,
+                ColorMapper.color_id_to_name(color_index),
+            )
+        return x, y, color_index
+
+    # Log in and store a fresh access token for a worker
+    def refresh_access_token(self, index, name, worker):
+        if not self.compactlogging:
+            logger.info("Thread #{} - {}: Refreshing access token", index, name)
+
+        # developer's reddit username and password
+        try:
+            username = name
+            password = worker["password"]
+        except Exception:
+            logger.exception(
+                "You need to provide all required fields to worker '{}'",
+                name,
+            )
+            exit(1)
 
-    def get_board(self, access_token_in):
-        logger.debug("Connecting and obtaining board images")
         while True:
             try:
-                ws = create_connection(
-                    "wss://gql-realtime-2.reddit.com/query",
-                    origin="https://hot-potato.reddit.com",
+                client = requests.Session()
+                client.proxies = proxy.get_random_proxy(self)
+                client.headers.update(
+                    {
+                        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.84 Safari/537.36"
+                    }
+                )
+
+                r = client.get(
+                    self.endpoints["login"],
+                    proxies=proxy.get_random_proxy(self),
+                    stream=True,
+                )
+                with r:
+                    csrf_token = auth.extract_csrf_token(
+                        r.iter_content(auth.CHUNK_SIZE)
+                    )
+                data = {
+                    "username": username,
+                    "password": password,
+                    "dest": self.endpoints["session"],
+                    "csrf_token": csrf_token,
+                }
+
+                r = client.post(
+                    self.endpoints["login"],
+                    data=data,
+                    proxies=proxy.get_random_proxy(self),
                 )
                 break
             except Exception:
@@ -182,474 +302,180 @@ class PlaceClient:
                 )
                 time.sleep(30)
 
-        ws.send(
-            json.dumps(
-                {
-                    "type": "connection_init",
-                    "payload": {"Authorization": "Bearer " + access_token_in},
-                }
-            )
-        )
-        while True:
-            msg = ws.recv()
-            if msg is None:
-                logger.error("Reddit failed to acknowledge connection_init")
-                exit()
-            if msg.startswith('{"type":"connection_ack"}'):
-                logger.debug("Connected to WebSocket server")
-                break
-        logger.debug("Obtaining Canvas information")
-        ws.send(
-            json.dumps(
-                {
-                    "id": "1",
-                    "type": "start",
-                    "payload": {
-                        "variables": {
-                            "input": {
-                                "channel": {
-                                    "teamOwner": "AFD2022",
-                                    "category": "CONFIG",
-                                }
-                            }
-                        },
-                        "extensions": {},
-                        "operationName": "configuration",
-                        "query": "subscription configuration($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on ConfigurationMessageData {\n          colorPalette {\n            colors {\n              hex\n              index\n              __typename\n            }\n            __typename\n          }\n          canvasConfigurations {\n            index\n            dx\n            dy\n            __typename\n          }\n          canvasWidth\n          canvasHeight\n          __typename\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
-                    },
-                }
-            )
+        if r.status_code != HTTPStatus.OK.value:
+            # password is probably invalid
+            logger.exception("Authorization failed!")
+            logger.debug("response: {} - {}", r.status_code, r.text)
+            return False
+        else:
+            logger.success("Authorization successful!")
+        logger.info("Obtaining access token...")
+        r = client.get(
+            self.endpoints["session"], proxies=proxy.get_random_proxy(self), stream=True
         )
+        with r:
+            response_data = auth.extract_session(r.iter_content(auth.CHUNK_SIZE))
 
-        while True:
-            canvas_payload = json.loads(ws.recv())
-            if canvas_payload["type"] == "data":
-                canvas_details = canvas_payload["payload"]["data"]["subscribe"]["data"]
-                logger.debug("Canvas config: {}", canvas_payload)
-                break
-
-        canvas_sockets = []
-
-        canvas_count = len(canvas_details["canvasConfigurations"])
-
-        for i in range(0, canvas_count):
-            canvas_sockets.append(2 + i)
-            logger.debug("Creating canvas socket {}", canvas_sockets[i])
-
-            ws.send(
-                json.dumps(
-                    {
-                        "id": str(2 + i),
-                        "type": "start",
-                        "payload": {
-                            "variables": {
-                                "input": {
-                                    "channel": {
-                                        "teamOwner": "AFD2022",
-                                        "category": "CANVAS",
-                                        "tag": str(i),
-                                    }
-                                }
-                            },
-                            "extensions": {},
-                            "operationName": "replace",
-                            "query": "subscription replace($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on FullFrameMessageData {\n          __typename\n          name\n          timestamp\n        }\n        ... on DiffFrameMessageData {\n          __typename\n          name\n          currentTimestamp\n          previousTimestamp\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
-                        },
-                    }
-                )
+        if "error" in response_data:
+            logger.info(
+                "An error occured. Make sure you have the correct credentials. Response data: {}",
+                response_data,
             )
-
-        imgs = []
-        logger.debug("A total of {} canvas sockets opened", len(canvas_sockets))
-
-        while len(canvas_sockets) > 0:
-            temp = json.loads(ws.recv())
-            logger.debug("Waiting for WebSocket message")
-
-            if temp["type"] == "data":
-                logger.debug("Received WebSocket data type message")
-                msg = temp["payload"]["data"]["subscribe"]
-
-                if msg["data"]["__typename"] == "FullFrameMessageData":
-                    logger.debug("Received full frame message")
-                    img_id = int(temp["id"])
-                    logger.debug("Image ID: {}", img_id)
-
-                    if img_id in canvas_sockets:
-                        logger.debug("Getting image: {}", msg["data"]["name"])
-                        imgs.append(
-                            [
-                                img_id,
-                                Image.open(
-                                    BytesIO(
-                                        requests.get(
-                                            msg["data"]["name"],
-                                            stream=True,
-                                            proxies=proxy.get_random_proxy(self),
-                                        ).content
-                                    )
-                                ),
-                            ]
-                        )
-                        canvas_sockets.remove(img_id)
-                        logger.debug(
-                            "Canvas sockets remaining: {}", len(canvas_sockets)
-                        )
-
-        for i in range(0, canvas_count - 1):
-            ws.send(json.dumps({"id": str(2 + i), "type": "stop"}))
-
-        ws.close()
-
-        new_img_width = (
-            max(map(lambda x: x["dx"], canvas_details["canvasConfigurations"]))
-            + canvas_details["canvasWidth"]
+            exit(1)
+
+        self.access_tokens[index] = response_data["accessToken"]
+        # access_token_type = data["user"]["session"]["accessToken"]  # this is just "bearer"
+        access_token_expires_in_seconds = response_data[
+            "expiresIn"
+        ]  # this is usually "3600"
+        # access_token_scope = response_data["scope"]  # this is usually "*"
+
+        # ts stores the time in seconds
+        self.access_token_expires_at_timestamp[index] = math.floor(time.time()) + int(
+            access_token_expires_in_seconds
         )
-        logger.debug("New image width: {}", new_img_width)
-
-        new_img_height = (
-            max(map(lambda x: x["dy"], canvas_details["canvasConfigurations"]))
-            + canvas_details["canvasHeight"]
-        )
-        logger.debug("New image height: {}", new_img_height)
-
-        new_img = Image.new("RGB", (new_img_width, new_img_height))
-
-        for idx, img in enumerate(sorted(imgs, key=lambda x: x[0])):
-            logger.debug("Adding image (ID {}): {}", img[0], img[1])
-            dx_offset = int(canvas_details["canvasConfigurations"][idx]["dx"])
-            dy_offset = int(canvas_details["canvasConfigurations"][idx]["dy"])
-            new_img.paste(img[1], (dx_offset, dy_offset))
-
-        return new_img
-
-    def get_unset_pixel(self, x, y, index):
-        originalX = x
-        originalY = y
-        loopedOnce = False
-        imgOutdated = True
-        wasWaiting = False
-
-        while True:
-            time.sleep(0.05)
-            if self.waiting_thread_index != -1 and self.waiting_thread_index != index:
-                x = originalX
-                y = originalY
-                loopedOnce = False
-                imgOutdated = True
-                wasWaiting = True
-                continue
-
-            # Stagger reactivation of threads after wait
-            if wasWaiting:
-                wasWaiting = False
-                time.sleep(index * self.delay_between_launches)
-
-            if x >= self.image_size[0]:
-                y += 1
-                x = 0
-
-            if y >= self.image_size[1]:
-
-                y = 0
-
-            if x == originalX and y == originalY and loopedOnce:
-                logger.info(
-                    "Thread #{} : All pixels correct, trying again in 10 seconds... ",
+        if not self.compactlogging:
+            logger.info(
+                "Received new access token: {}************",
+                self.access_tokens.get(index)[:5],
+            )
+        auth.save_token_cache(self)
+        return True
+
+    def access_token_expired(self, index):
+        return index not in self.access_token_expires_at_timestamp or math.floor(
+            time.time()
+        ) >= self.access_token_expires_at_timestamp.get(index)
+
+    # Place a pixel leased from the scheduler
+    # Returns the timestamp at which the worker may place again
+    def place_pixel(self, index, name, current_r, current_c, color_index):
+        logger.info("\nAccount Placing: ", name, "\n")
+
+        # draw the pixel onto r/place
+        # There's a better way to do this
+        canvas = 0
+        pixel_x_start = self.pixel_x_start + current_r
+        pixel_y_start = self.pixel_y_start + current_c
+        while pixel_x_start > 999:
+            pixel_x_start -= 1000
+            canvas += 1
+        while pixel_y_start > 999:
+            pixel_y_start -= 1000
+            canvas += 2
+
+        # draw the pixel onto r/place
+        placed = False
+        try:
+            with self.profiler.span("set_pixel_and_check_ratelimit", index):
+                next_pixel_placement_time, placed = self.set_pixel_and_check_ratelimit(
+                    self.access_tokens[index],
+                    pixel_x_start,
+                    pixel_y_start,
+                    name,
+                    color_index,
+                    canvas,
                     index,
                 )
-                self.waiting_thread_index = index
-                time.sleep(10)
-                imgOutdated = True
-
-            if imgOutdated:
-                boardimg = self.get_board(self.access_tokens[index])
-                pix2 = boardimg.convert("RGB").load()
-                imgOutdated = False
+        finally:
+            self.scheduler.release(current_r, current_c, placed)
 
-            logger.debug("{}, {}", x + self.pixel_x_start, y + self.pixel_y_start)
-            logger.debug(
-                "{}, {}, boardimg, {}, {}", x, y, self.image_size[0], self.image_size[1]
+        if self.unverified_place_frequency:
+            # the limit holds even when the response allows an earlier placement
+            next_pixel_placement_time = max(
+                next_pixel_placement_time, time.time() + UNVERIFIED_PLACE_FREQUENCY
             )
+        return next_pixel_placement_time
 
-            target_rgb = self.pix[x, y]
-
-            new_rgb = ColorMapper.closest_color(
-                target_rgb, self.rgb_colors_array, self.legacy_transparency
-            )
-            if pix2[x + self.pixel_x_start, y + self.pixel_y_start] != new_rgb:
-                logger.debug(
-                    "{}, {}, {}, {}",
-                    pix2[x + self.pixel_x_start, y + self.pixel_y_start],
-                    new_rgb,
-                    new_rgb != (69, 42, 0),
-                    pix2[x, y] != new_rgb,
-                )
-
-                # (69, 42, 0) is a special color reserved for transparency.
-                if new_rgb != (69, 42, 0):
-                    logger.debug(
-                        "Thread #{} : Replacing {} pixel at: {},{} with {} color",
-                        index,
-                        pix2[x + self.pixel_x_start, y + self.pixel_y_start],
-                        x + self.pixel_x_start,
-                        y + self.pixel_y_start,
-                        new_rgb,
-                    )
-                    break
-                else:
-                    logger.info(
-                        "Transparent Pixel at {}, {} skipped",
-                        x + self.pixel_x_start,
-                        y + self.pixel_y_start,
-                    )
-            x += 1
-            loopedOnce = True
-        return x, y, new_rgb
-
-    # Draw the input image
+    # Draw the next pixel of the input image
+    # Returns the timestamp at which the worker may place again, None to stop it
     def task(self, index, name, worker):
-        # Whether image should keep drawing itself
-        repeat_forever = True
-
-        while True:
-            # last_time_placed_pixel = math.floor(time.time())
+        if index in self.token_refresher.failed:
+            return None
+
+        # get current pixel position from input image and replacement color
+        current_r, current_c, pixel_color_index = self.get_unset_pixel(index)
+        return self.place_pixel(index, name, current_r, current_c, pixel_color_index)
+
+    # Whether a worker may keep going after a placement, logs the wait
+    def check_next_placement(self, index, name, next_pixel_placement_time):
+        time_until_next_draw = math.floor(next_pixel_placement_time - time.time())
+        if time_until_next_draw > 10000:
+            logger.warning(
+                "Thread #{} - {} :: CANCELLED :: Rate-Limit Banned", index, name
+            )
+            return False
 
-            # note: Reddit limits us to place 1 pixel every 5 minutes, so I am setting it to
-            # 5 minutes and 30 seconds per pixel
-            if self.unverified_place_frequency:
-                pixel_place_frequency = 1230
+        if not self.compactlogging:
+            logger.info(
+                "Thread #{} - {}: {} seconds until next pixel is drawn",
+                index,
+                name,
+                time_until_next_draw,
+            )
+        return True
+
+    # Run one turn of a worker and put it back on the timer
+    def run_task(self, index, name, worker):
+        # tokens are renewed in the background, a worker without a usable one
+        # leaves the timer until the refresher hands it back
+        if self.token_refresher.hold(
+            index, lambda: self.cooldowns.schedule(index, time.time())
+        ):
+            return
+
+        next_pixel_placement_time = None
+        try:
+            next_pixel_placement_time = self.task(index, name, worker)
+        except Exception:
+            logger.exception(
+                "Thread #{} - {}: Failed placing pixel, trying again in 30 seconds...",
+                index,
+                name,
+            )
+            next_pixel_placement_time = time.time() + 30
+        finally:
+            if next_pixel_placement_time is None or not self.check_next_placement(
+                index, name, next_pixel_placement_time
+            ):
+                self.cooldowns.retire(index)
+                self.metrics.active_workers.dec()
             else:
-                pixel_place_frequency = 330
+                self.cooldowns.schedule(index, next_pixel_placement_time)
 
-            next_pixel_placement_time = math.floor(time.time()) + pixel_place_frequency
+    def start(self):
+        self.token_refresher.start()
+        self.template_watcher.start()
 
-            try:
-                # Current pixel row and pixel column being drawn
-                current_r = worker["start_coords"][0]
-                current_c = worker["start_coords"][1]
-            except Exception:
-                logger.info("You need to provide start_coords to worker '{}'", name)
-                exit(1)
+        workers = self.json_data["workers"]
+        names = list(workers)
 
-            # Time until next pixel is drawn
-            update_str = ""
+        # Stagger the first placement of every worker
+        now = time.time()
+        for index in range(len(names)):
+            self.cooldowns.schedule(index, now + index * self.delay_between_launches)
+            self.metrics.active_workers.inc()
 
-            # Refresh auth tokens and / or draw a pixel
+        # Only workers whose cooldown expired are handed to the pool
+        with ThreadPoolExecutor(max_workers=max(len(names), 1)) as executor:
             while True:
-                # reduce CPU usage
-                time.sleep(1)
-
-                # get the current time
-                current_timestamp = math.floor(time.time())
-
-                # log next time until drawing
-                time_until_next_draw = next_pixel_placement_time - current_timestamp
-
-                if time_until_next_draw > 10000:
-                    logger.warning(
-                        "Thread #{} - {} :: CANCELLED :: Rate-Limit Banned", index, name
-                    )
-                    repeat_forever = False
+                due = self.cooldowns.wait_due()
+                if len(due) == 0:
                     break
-
-                new_update_str = (
-                    f"{time_until_next_draw} seconds until next pixel is drawn"
-                )
-
-                if update_str != new_update_str and time_until_next_draw % 10 == 0:
-                    update_str = new_update_str
-                else:
-                    update_str = ""
-
-                if len(update_str) > 0:
-                    if not self.compactlogging:
-                        logger.info("Thread #{} - {}: {}", index, name, update_str)
-
-                # refresh access token if necessary
-                if (
-                    len(self.access_tokens) == 0
-                    or len(self.access_token_expires_at_timestamp) == 0
-                    or
-                    # index in self.access_tokens
-                    index not in self.access_token_expires_at_timestamp
-                    or (
-                        self.access_token_expires_at_timestamp.get(index)
-                        and current_timestamp
-                        >= self.access_token_expires_at_timestamp.get(index)
-                    )
-                ):
-                    if not self.compactlogging:
-                        logger.info(
-                            "Thread #{} - {}: Refreshing access token", index, name
-                        )
-
-                    # developer's reddit username and password
-                    try:
-                        username = name
-                        password = worker["password"]
-                    except Exception:
-                        logger.exception(
-                            "You need to provide all required fields to worker '{}'",
-                            name,
-                        )
-                        exit(1)
-
-                    while True:
-                        try:
-                            client = requests.Session()
-                            client.proxies = proxy.get_random_proxy(self)
-                            client.headers.update(
-                                {
-                                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/99.0.4844.84 Safari/537.36"
-                                }
-                            )
-
-                            r = client.get(
-                                "https://www.reddit.com/login",
-                                proxies=proxy.get_random_proxy(self),
-                            )
-                            login_get_soup = BeautifulSoup(r.content, "html.parser")
-                            csrf_token = login_get_soup.find(
-                                "input", {"name": "csrf_token"}
-                            )["value"]
-                            data = {
-                                "username": username,
-                                "password": password,
-                                "dest": "https://new.reddit.com/",
-                                "csrf_token": csrf_token,
-                            }
-
-                            r = client.post(
-                                "https://www.reddit.com/login",
-                                data=data,
-                                proxies=proxy.get_random_proxy(self),
-                            )
-                            break
-                        except Exception:
-                            logger.error(
-                                "Failed to connect to websocket, trying again in 30 seconds..."
-                            )
-                            time.sleep(30)
-
-                    if r.status_code != HTTPStatus.OK.value:
-                        # password is probably invalid
-                        logger.exception("Authorization failed!")
-                        logger.debug("response: {} - {}", r.status_code, r.text)
-                        return
-                    else:
-                        logger.success("Authorization successful!")
-                    logger.info("Obtaining access token...")
-                    r = client.get(
-                        "https://new.reddit.com/", proxies=proxy.get_random_proxy(self)
-                    )
-                    data_str = (
-                        BeautifulSoup(r.content, features="html.parser")
-                        .find("script", {"id": "data"})
-                        .contents[0][len("window.__r = ") : -1]
-                    )
-                    data = json.loads(data_str)
-                    response_data = data["user"]["session"]
-
-                    if "error" in response_data:
-                        logger.info(
-                            "An error occured. Make sure you have the correct credentials. Response data: {}",
-                            response_data,
-                        )
-                        exit(1)
-
-                    self.access_tokens[index] = response_data["accessToken"]
-                    # access_token_type = data["user"]["session"]["accessToken"]  # this is just "bearer"
-                    access_token_expires_in_seconds = response_data[
-                        "expiresIn"
-                    ]  # this is usually "3600"
-                    # access_token_scope = response_data["scope"]  # this is usually "*"
-
-                    # ts stores the time in seconds
-                    self.access_token_expires_at_timestamp[
-                        index
-                    ] = current_timestamp + int(access_token_expires_in_seconds)
-                    if not self.compactlogging:
-                        logger.info(
-                            "Received new access token: {}************",
-                            self.access_tokens.get(index)[:5],
-                        )
-
-                # draw pixel onto screen
-                if self.access_tokens.get(index) is not None and (
-                    current_timestamp >= next_pixel_placement_time
-                    or self.first_run_counter <= index
-                ):
-
-                    # place pixel immediately
-                    # first_run = False
-                    self.first_run_counter += 1
-
-                    # get target color
-                    # target_rgb = pix[current_r, current_c]
-
-                    # get current pixel position from input image and replacement color
-                    current_r, current_c, new_rgb = self.get_unset_pixel(
-                        current_r,
-                        current_c,
-                        index,
-                    )
-
-                    # get converted color
-                    new_rgb_hex = ColorMapper.rgb_to_hex(new_rgb)
-                    pixel_color_index = ColorMapper.COLOR_MAP[new_rgb_hex]
-
-                    logger.info("\nAccount Placing: ", name, "\n")
-
-                    # draw the pixel onto r/place
-                    # There's a better way to do this
-                    canvas = 0
-                    pixel_x_start = self.pixel_x_start + current_r
-                    pixel_y_start = self.pixel_y_start + current_c
-                    while pixel_x_start > 999:
-                        pixel_x_start -= 1000
-                        canvas += 1
-                    while pixel_y_start > 999:
-                        pixel_y_start -= 1000
-                        canvas += 2
-
-                    # draw the pixel onto r/place
-                    next_pixel_placement_time = self.set_pixel_and_check_ratelimit(
-                        self.access_tokens[index],
-                        pixel_x_start,
-                        pixel_y_start,
-                        name,
-                        pixel_color_index,
-                        canvas,
-                        index,
+                for index in due:
+                    executor.submit(
+                        self.run_task, index, names[index], workers[names[index]]
                     )
 
-                    current_r += 1
-
-                    # go back to first column when reached end of a row while drawing
-                    if current_r >= self.image_size[0]:
-                        current_r = 0
-                        current_c += 1
-
-                    # exit when all pixels drawn
-                    if current_c >= self.image_size[1]:
-                        logger.info("Thread #{} :: image completed", index)
-                        break
-
-            if not repeat_forever:
-                break
 
-    def start(self):
-        for index, worker in enumerate(self.json_data["workers"]):
-            threading.Thread(
-                target=self.task,
-                args=[index, worker, self.json_data["workers"][worker]],
-            ).start()
-            # exit(1)
-            time.sleep(self.delay_between_launches)
+def setup_logging(debug: bool):
+    if not debug:
+        # default loguru level is DEBUG
+        logger.remove()
+        logger.add(sys.stderr, level="INFO")
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option(
     "-d",
     "--debug",
@@ -662,16 +488,102 @@ class PlaceClient:
     default="config.json",
     help="Location of config.json",
 )
-def main(debug: bool, config: str):
+@click.option(
+    "-e",
+    "--engine",
+    type=click.Choice(["threads", "async"]),
+    default="threads",
+    help="Run workers on a thread pool or as coroutines on one event loop.",
+)
+@click.option(
+    "--concurrency",
+    default=32,
+    help="Maximum number of pixel claims and placements in flight with the async engine, logins use token_refresh_workers.",
+)
+@click.option(
+    "--metrics-port",
+    type=int,
+    help="Serve Prometheus metrics on this port at /metrics.",
+)
+@click.option(
+    "--metrics-host",
+    default="127.0.0.1",
+    help="Address the metrics endpoint listens on.",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Time every stage and write a summary and a trace file at exit.",
+)
+@click.option(
+    "--profile-output",
+    default="profile_trace.json",
+    help="Where --profile writes the trace, open it in chrome://tracing or Perfetto.",
+)
+@click.option(
+    "--journal",
+    default=0,
+    help="Keep the last this many pixel claims and placements in memory.",
+)
+@click.option(
+    "--journal-output",
+    default="journal.log",
+    help="Where the journal is written on SIGUSR1 and at exit.",
+)
+@click.pass_context
+def main(
+    ctx,
+    debug: bool,
+    config: str,
+    engine: str,
+    concurrency: int,
+    metrics_port: int,
+    metrics_host: str,
+    profile: bool,
+    profile_output: str,
+    journal: int,
+    journal_output: str,
+):
+    setup_logging(debug)
+    ctx.obj = {"config": config}
+    if ctx.invoked_subcommand is not None:
+        return
+
+    client = PlaceClient(config_path=config, debug=debug)
+    if metrics_port is not None:
+        client.metrics.serve(metrics_host, metrics_port)
+    client.profiler.enabled = profile
+    client.journal.resize(journal)
+    if journal > 0 and hasattr(signal, "SIGUSR1"):
+        # kill -USR1 <pid> dumps the journal without stopping the script
+        signal.signal(
+            signal.SIGUSR1, lambda signum, frame: client.journal.dump(journal_output)
+        )
+    # Start everything
+    try:
+        if engine == "async":
+            AsyncEngine(client, concurrency).start()
+        else:
+            client.start()
+    finally:
+        # also on Ctrl+C, which is how a run usually ends
+        if profile:
+            client.profiler.write(profile_output)
+        client.journal.dump(journal_output)
 
-    if not debug:
-        # default loguru level is DEBUG
-        logger.remove()
-        logger.add(sys.stderr, level="INFO")
 
-    client = PlaceClient(config_path=config)
-    # Start everything
-    client.start()
+@main.command("compile")
+@click.option(
+    "-o",
+    "--output",
+    default="template.bin",
+    help="Where to write the compiled template.",
+)
+@click.pass_context
+def compile_template(ctx, output: str):
+    """Quantize the image once into a template that loads without decoding."""
+    client = PlaceClient(config_path=ctx.obj["config"], offline=True)
+    utils.compile_image(client, output)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,31 @@
 import nox
 
-locations = "main.py", "noxfile.py", "src/mappings.py", "src/proxy.py", "src/utils.py"
+locations = (
+    "benchmarks/fake_place.py",
+    "benchmarks/hot_paths.py",
+    "benchmarks/load_test.py",
+    "benchmarks/token_extraction.py",
+    "main.py",
+    "noxfile.py",
+    "src/auth.py",
+    "src/board.py",
+    "src/cache.py",
+    "src/diff.py",
+    "src/engine.py",
+    "src/heatmap.py",
+    "src/journal.py",
+    "src/mappings.py",
+    "src/metrics.py",
+    "src/profiler.py",
+    "src/proxy.py",
+    "src/quantize.py",
+    "src/reload.py",
+    "src/scheduler.py",
+    "src/template.py",
+    "src/timer.py",
+    "src/transport.py",
+    "src/utils.py",
+)
 
 
 # This is not run automatically
@@ -18,4 +43,11 @@ def lint(session):
     session.run("flake8", *args)
 
 
+# Not run by default either, pass options after --, see benchmarks/hot_paths.py
+@nox.session
+def benchmarks(session):
+    session.install("-r", "requirements.txt")
+    session.run("python", "-m", "benchmarks.hot_paths", *session.posargs)
+
+
 nox.options.sessions = ["lint"]
@@ -0,0 +1,263 @@
+import html
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bs4 import BeautifulSoup
+
+from src.timer import CooldownTimer
+
+# Tokens this close to expiring are not worth loading from the cache, in seconds
+CACHE_EXPIRY_MARGIN = 60
+
+_cache_lock = threading.Lock()
+
+# Size of the pieces login pages are read in while looking for tokens
+CHUNK_SIZE = 16384
+
+CSRF_INPUT = re.compile(rb'<input[^>]*\bname="csrf_token"[^>]*>')
+VALUE_ATTRIBUTE = re.compile(rb'\bvalue="([^"]*)"')
+SESSION_DATA_START = b"window.__r = "
+USER_KEY = b'"user":'
+SESSION_KEY = b'"session":'
+# longest pattern above, matches straddling two chunks must still be found
+PATTERN_OVERLAP = 512
+
+
+def load_token_cache(self):
+    """Restore access tokens that are still valid from the cache file"""
+    if self.token_cache_path is None or not os.path.exists(self.token_cache_path):
+        return
+
+    try:
+        with open(self.token_cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        self.logger.exception("Failed to read token cache, logging in again")
+        return
+    if not isinstance(cache, dict):
+        self.logger.error("Token cache is not a JSON object, logging in again")
+        return
+
+    now = time.time()
+    for index, name in enumerate(self.json_data["workers"]):
+        entry = cache.get(name)
+        if entry is None:
+            continue
+        try:
+            access_token = entry["access_token"]
+            expires_at = float(entry["expires_at"])
+        except (KeyError, TypeError, ValueError):
+            # a hand edited or truncated entry only costs that worker a login
+            self.logger.warning("Ignoring malformed token cache entry of {}", name)
+            continue
+        if expires_at - CACHE_EXPIRY_MARGIN <= now:
+            continue
+        self.access_tokens[index] = access_token
+        self.access_token_expires_at_timestamp[index] = expires_at
+
+    self.logger.info(
+        "Loaded {} cached access tokens from {}",
+        len(self.access_tokens),
+        self.token_cache_path,
+    )
+
+
+def save_token_cache(self):
+    """Write every known access token to the cache file, keyed by username"""
+    if self.token_cache_path is None:
+        return
+
+    names = list(self.json_data["workers"])
+    with _cache_lock:
+        cache = {
+            names[index]: {
+                "access_token": access_token,
+                "expires_at": self.access_token_expires_at_timestamp[index],
+            }
+            for index, access_token in list(self.access_tokens.items())
+            if index in self.access_token_expires_at_timestamp
+        }
+
+        # the file holds credentials, keep it private and never half written
+        tmp_path = self.token_cache_path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, self.token_cache_path)
+
+
+class TokenRefresher:
+    """Renews access tokens in the background, ahead of their expiry.
+
+    Workers never log in themselves: a bounded pool does it and the new token
+    replaces the old one in client.access_tokens in a single assignment.
+    """
+
+    # how long before expiresIn runs out a token gets renewed, in seconds
+    REFRESH_AHEAD = 300
+
+    def __init__(self, client, max_workers=4):
+        self.client = client
+        self.logger = client.logger
+        self.max_workers = max_workers
+
+        self.timer = CooldownTimer()
+        self.lock = threading.Lock()
+        # indices of workers whose credentials were rejected
+        self.failed = set()
+        # index -> callback handing a worker without a usable token back
+        self.waiting = {}
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        now = time.time()
+        for index in range(len(self.client.json_data["workers"])):
+            expires_at = self.client.access_token_expires_at_timestamp.get(index, now)
+            self.timer.schedule(index, expires_at - self.REFRESH_AHEAD)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def hold(self, index, resume):
+        """Keep a worker without a usable token waiting, True if it has to
+
+        resume() is called once a new token is stored or the login failed.
+        """
+        with self.lock:
+            if index in self.failed or not self.client.access_token_expired(index):
+                return False
+            self.waiting[index] = resume
+            return True
+
+    def hand_back(self, index):
+        with self.lock:
+            resume = self.waiting.pop(index, None)
+        if resume is not None:
+            resume()
+
+    def run(self):
+        workers = self.client.json_data["workers"]
+        names = list(workers)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                due = self.timer.wait_due()
+                if len(due) == 0:
+                    break
+                for index in due:
+                    executor.submit(
+                        self.refresh, index, names[index], workers[names[index]]
+                    )
+
+    def refresh(self, index, name, worker):
+        try:
+            with self.client.profiler.span("refresh_access_token", index):
+                with self.client.metrics.login_seconds.time():
+                    refreshed = self.client.refresh_access_token(index, name, worker)
+        except SystemExit:
+            # missing fields or a login error, retrying will not help
+            refreshed = False
+        except Exception:
+            self.logger.exception(
+                "Thread #{} - {}: Failed refreshing access token, trying again in 30 seconds...",
+                index,
+                name,
+            )
+            self.timer.schedule(index, time.time() + 30)
+            return
+
+        if not refreshed:
+            with self.lock:
+                self.failed.add(index)
+            self.timer.retire(index)
+        else:
+            self.timer.schedule(
+                index,
+                self.client.access_token_expires_at_timestamp[index]
+                - self.REFRESH_AHEAD,
+            )
+        # a waiting worker places with its new token or notices it failed
+        self.hand_back(index)
+
+
+class PageReader:
+    """Buffers a page chunk by chunk so scanning can stop as soon as possible"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def read_more(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer += chunk
+                return True
+        return False
+
+    def read_all(self):
+        self.buffer += b"".join(self.chunks)
+        return self.buffer
+
+
+def extract_csrf_token(chunks):
+    """csrf_token of the login form, read only up to the input holding it"""
+    reader = PageReader(chunks)
+    searched = 0
+    while reader.read_more():
+        match = CSRF_INPUT.search(reader.buffer, max(0, searched - PATTERN_OVERLAP))
+        searched = len(reader.buffer)
+        if match is None:
+            continue
+        value = VALUE_ATTRIBUTE.search(match.group(0))
+        if value is not None:
+            return html.unescape(value.group(1).decode())
+
+    # unexpected markup, fall back to a full parse
+    return BeautifulSoup(reader.read_all(), "html.parser").find(
+        "input", {"name": "csrf_token"}
+    )["value"]
+
+
+def extract_session(chunks):
+    """user.session object of window.__r, without parsing the rest of the page"""
+    reader = PageReader(chunks)
+    decoder = json.JSONDecoder()
+    # position of the next "session" key worth trying to decode
+    candidate = 0
+    start = -1
+    while reader.read_more():
+        if start == -1:
+            start = reader.buffer.find(SESSION_DATA_START)
+            if start == -1:
+                continue
+            candidate = start
+
+        while True:
+            user = reader.buffer.find(USER_KEY, candidate)
+            session = -1 if user == -1 else reader.buffer.find(SESSION_KEY, user)
+            if session == -1:
+                break
+            try:
+                value, _ = decoder.raw_decode(
+                    reader.buffer[session + len(SESSION_KEY) :]
+                    .decode("utf-8", "replace")
+                    .lstrip()
+                )
+            except ValueError:
+                # the object is not complete yet
+                break
+            if isinstance(value, dict) and ("accessToken" in value or "error" in value):
+                return value
+            candidate = user + len(USER_KEY)
+
+    # unexpected markup, fall back to a full parse
+    data_str = (
+        BeautifulSoup(reader.read_all(), features="html.parser")
+        .find("script", {"id": "data"})
+        .contents[0][len("window.__r = ") : -1]
+    )
+    return json.loads(data_str)["user"]["session"]
@@ -0,0 +1,386 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from websocket import WebSocketTimeoutException, create_connection
+
+from src.mappings import ColorMapper
+import src.diff as diff
+import src.transport as transport
+
+CONFIG_QUERY = "subscription configuration($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on ConfigurationMessageData {\n          colorPalette {\n            colors {\n              hex\n              index\n              __typename\n            }\n            __typename\n          }\n          canvasConfigurations {\n            index\n            dx\n            dy\n            __typename\n          }\n          canvasWidth\n          canvasHeight\n          __typename\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n"
+CANVAS_QUERY = "subscription replace($input: SubscribeInput!) {\n  subscribe(input: $input) {\n    id\n    ... on BasicMessage {\n      data {\n        __typename\n        ... on FullFrameMessageData {\n          __typename\n          name\n          timestamp\n        }\n        ... on DiffFrameMessageData {\n          __typename\n          name\n          currentTimestamp\n          previousTimestamp\n        }\n      }\n      __typename\n    }\n    __typename\n  }\n}\n"
+
+# subscription id 1 is the config channel, canvas channels start at 2
+CANVAS_SUBSCRIPTION_OFFSET = 2
+# In seconds, how long a quiet socket may delay applying a new region
+REGION_POLL_INTERVAL = 1
+
+
+class BoardMirror:
+    """Single long-lived websocket subscription mirroring the board under the template.
+
+    Full frames (re)initialise a canvas, diff frames are pasted on top of it.
+    Workers read the board through get_board() instead of opening their own socket.
+
+    Frames are downloaded and decoded on one single-threaded executor per canvas:
+    canvases load concurrently while the frames of a canvas stay in order. Each
+    decoded frame is mapped to palette indices once and written straight into a
+    preallocated uint8 array, a third of the size of an RGB board.
+
+    Only canvases overlapping the template are subscribed to, and only the
+    template's bounding box is kept, its top left corner on the board is `origin`.
+
+    Reads take no lock: get_board() and get_region() return read-only views of
+    the live array, which frames keep updating in place.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.logger = client.logger
+
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.thread = None
+
+        # Template bounding box on the board, (x0, y0, x1, y1) with x1, y1 exclusive
+        self.region = (
+            client.pixel_x_start,
+            client.pixel_y_start,
+            client.pixel_x_start + client.image_size[0],
+            client.pixel_y_start + client.image_size[1],
+        )
+        # [y, x] palette indices of the part of the region that exists on the board,
+        # TRANSPARENT_INDEX where the color is unknown
+        self.board = None
+        self.origin = (0, 0)
+        self.canvas_details = None
+        # configurations of the canvases overlapping the region
+        self.canvases = []
+        # canvas index -> timestamp of the last frame queued
+        self.canvas_timestamps = {}
+        # canvas indices that received at least one full frame
+        self.received_canvases = set()
+        # canvas index -> executor downloading its frames
+        self.canvas_executors = {}
+        # set by set_region, the websocket thread applies it after its next message
+        self.region_changed = False
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def get_board(self):
+        """Read-only view of the mirrored region, blocks until every canvas was received once"""
+        self.ready.wait()
+        # frames are written in place, a reallocated buffer replaces the reference
+        board = self.board.view()
+        board.flags.writeable = False
+        return board
+
+    def get_region(self, x, y, width, height):
+        """Read-only view of a rectangle given in board coordinates"""
+        # origin is only meaningful once get_board() stopped waiting
+        board = self.get_board()
+        x0, y0 = self.origin
+        return board[
+            max(y - y0, 0) : max(y - y0 + height, 0),
+            max(x - x0, 0) : max(x - x0 + width, 0),
+        ]
+
+    def set_region(self, region):
+        """Mirror another bounding box, the websocket thread resubscribes canvases
+        as needed within REGION_POLL_INTERVAL"""
+        with self.lock:
+            if region == self.region:
+                return
+            self.region = region
+            # the buffer no longer lines up with the template, hold readers
+            # until the new region was received
+            self.ready.clear()
+            self.region_changed = True
+
+    def get_access_token(self):
+        while True:
+            tokens = list(self.client.access_tokens.values())
+            if len(tokens) > 0:
+                return tokens[0]
+            time.sleep(1)
+
+    def run(self):
+        while True:
+            try:
+                self.sync()
+            except Exception:
+                self.logger.exception("Board websocket failed, reconnecting...")
+            # subscriptions died with the socket, the next config subscribes to
+            # every canvas again and readers wait for their fresh full frames
+            with self.lock:
+                self.canvas_timestamps = {}
+                self.canvas_details = None
+                self.canvases = []
+                self.received_canvases = set()
+                self.ready.clear()
+            time.sleep(5)
+
+    def sync(self):
+        self.logger.debug("Connecting and obtaining board images")
+        while True:
+            try:
+                with self.client.profiler.span("websocket_connect"):
+                    ws = create_connection(
+                        self.client.endpoints["websocket"],
+                        origin="https://hot-potato.reddit.com",
+                    )
+                break
+            except Exception:
+                self.logger.error(
+                    "Failed to connect to websocket, trying again in 30 seconds..."
+                )
+                time.sleep(30)
+
+        try:
+            ws.send(
+                json.dumps(
+                    {
+                        "type": "connection_init",
+                        "payload": {
+                            "Authorization": "Bearer " + self.get_access_token()
+                        },
+                    }
+                )
+            )
+            while True:
+                msg = ws.recv()
+                if not msg:
+                    raise ConnectionError(
+                        "Reddit failed to acknowledge connection_init"
+                    )
+                if msg.startswith('{"type":"connection_ack"}'):
+                    self.logger.debug("Connected to WebSocket server")
+                    break
+
+            self.logger.debug("Obtaining Canvas information")
+            self.subscribe(
+                ws, "1", {"category": "CONFIG"}, "configuration", CONFIG_QUERY
+            )
+
+            # recv() returns now and then even when no frames come in
+            ws.settimeout(REGION_POLL_INTERVAL)
+            while True:
+                try:
+                    msg = ws.recv()
+                except WebSocketTimeoutException:
+                    pass
+                else:
+                    if not msg:
+                        raise ConnectionError("Board websocket closed")
+                    self.handle_message(ws, json.loads(msg))
+                if self.region_changed and self.canvas_details is not None:
+                    self.apply_config(ws, self.canvas_details)
+        finally:
+            ws.close()
+
+    @staticmethod
+    def subscribe(ws, subscription_id, channel, operation_name, query):
+        ws.send(
+            json.dumps(
+                {
+                    "id": subscription_id,
+                    "type": "start",
+                    "payload": {
+                        "variables": {
+                            "input": {"channel": {"teamOwner": "AFD2022", **channel}}
+                        },
+                        "extensions": {},
+                        "operationName": operation_name,
+                        "query": query,
+                    },
+                }
+            )
+        )
+
+    def subscribe_canvas(self, ws, canvas_index):
+        self.logger.debug("Subscribing to canvas {}", canvas_index)
+        self.subscribe(
+            ws,
+            str(CANVAS_SUBSCRIPTION_OFFSET + canvas_index),
+            {"category": "CANVAS", "tag": str(canvas_index)},
+            "replace",
+            CANVAS_QUERY,
+        )
+
+    def resubscribe_canvas(self, ws, canvas_index):
+        ws.send(
+            json.dumps(
+                {"id": str(CANVAS_SUBSCRIPTION_OFFSET + canvas_index), "type": "stop"}
+            )
+        )
+        self.canvas_timestamps.pop(canvas_index, None)
+        self.subscribe_canvas(ws, canvas_index)
+
+    def handle_message(self, ws, payload):
+        if payload["type"] != "data":
+            return
+        data = payload["payload"]["data"]["subscribe"]["data"]
+
+        if data["__typename"] == "ConfigurationMessageData":
+            self.apply_config(ws, data)
+            return
+
+        canvas_index = int(payload["id"]) - CANVAS_SUBSCRIPTION_OFFSET
+        if data["__typename"] == "FullFrameMessageData":
+            self.logger.debug("Received full frame for canvas {}", canvas_index)
+            self.queue_frame(canvas_index, data["name"], data["timestamp"], False)
+        elif data["__typename"] == "DiffFrameMessageData":
+            if self.canvas_timestamps.get(canvas_index) != data["previousTimestamp"]:
+                # a diff was missed, the mirror can only be trusted after a full frame
+                self.logger.debug("Canvas {} out of sync, resubscribing", canvas_index)
+                self.resubscribe_canvas(ws, canvas_index)
+                return
+            self.queue_frame(canvas_index, data["name"], data["currentTimestamp"], True)
+
+    def overlaps(self, configuration, canvas_details):
+        x0, y0, x1, y1 = self.region
+        return (
+            configuration["dx"] < x1
+            and configuration["dx"] + canvas_details["canvasWidth"] > x0
+            and configuration["dy"] < y1
+            and configuration["dy"] + canvas_details["canvasHeight"] > y0
+        )
+
+    def apply_config(self, ws, canvas_details):
+        self.logger.debug("Canvas config: {}", canvas_details)
+        self.region_changed = False
+        configurations = canvas_details["canvasConfigurations"]
+        width = max(c["dx"] for c in configurations) + canvas_details["canvasWidth"]
+        height = max(c["dy"] for c in configurations) + canvas_details["canvasHeight"]
+
+        # the part of the template that is actually on the board
+        x0, y0 = max(self.region[0], 0), max(self.region[1], 0)
+        x1, y1 = min(self.region[2], width), min(self.region[3], height)
+        canvases = [c for c in configurations if self.overlaps(c, canvas_details)]
+        self.logger.debug(
+            "Mirroring {}x{} at {}, {} from canvases {}",
+            x1 - x0,
+            y1 - y0,
+            x0,
+            y0,
+            [c["index"] for c in canvases],
+        )
+
+        previous = set(c["index"] for c in self.canvases)
+        with self.lock:
+            reallocated = self.board is None or self.origin != (x0, y0)
+            reallocated = reallocated or self.board.shape[:2] != (y1 - y0, x1 - x0)
+            if reallocated:
+                self.board = np.full(
+                    (max(y1 - y0, 0), max(x1 - x0, 0)),
+                    ColorMapper.TRANSPARENT_INDEX,
+                    dtype=np.uint8,
+                )
+                self.origin = (x0, y0)
+                self.received_canvases = set()
+                self.ready.clear()
+            self.canvas_details = canvas_details
+            self.canvases = canvases
+
+        for configuration in canvases:
+            canvas_index = configuration["index"]
+            if canvas_index not in self.canvas_executors:
+                self.canvas_executors[canvas_index] = ThreadPoolExecutor(max_workers=1)
+            # a fresh full frame is needed for every canvas of a new buffer
+            if reallocated and canvas_index in previous:
+                self.resubscribe_canvas(ws, canvas_index)
+            elif canvas_index not in previous:
+                self.subscribe_canvas(ws, canvas_index)
+
+        for canvas_index in previous - set(c["index"] for c in canvases):
+            self.logger.debug("Unsubscribing from canvas {}", canvas_index)
+            ws.send(
+                json.dumps(
+                    {
+                        "id": str(CANVAS_SUBSCRIPTION_OFFSET + canvas_index),
+                        "type": "stop",
+                    }
+                )
+            )
+            self.canvas_timestamps.pop(canvas_index, None)
+
+        # a new region that fits the current buffer needs no new frames
+        with self.lock:
+            if self.canvases and all(
+                c["index"] in self.received_canvases for c in self.canvases
+            ):
+                self.ready.set()
+
+    def queue_frame(self, canvas_index, url, timestamp, is_diff):
+        self.canvas_timestamps[canvas_index] = timestamp
+        self.canvas_executors[canvas_index].submit(
+            self.apply_frame, canvas_index, url, is_diff
+        )
+
+    @staticmethod
+    def decode_frame(body):
+        # diff frames are transparent where nothing changed
+        return np.asarray(Image.open(BytesIO(body)).convert("RGBA"))
+
+    def apply_frame(self, canvas_index, url, is_diff):
+        try:
+            with self.client.profiler.span("download_frame"):
+                body = transport.download(self.client, url)
+            with self.client.profiler.span("decode_frame"):
+                with self.client.metrics.frame_decode_seconds.time():
+                    frame = self.decode_frame(body)
+            self.paste_frame(canvas_index, frame, is_diff)
+        except Exception:
+            self.logger.exception("Failed to apply frame of canvas {}", canvas_index)
+            # the next diff will not line up and trigger a resubscribe
+            self.canvas_timestamps.pop(canvas_index, None)
+
+    def paste_frame(self, canvas_index, frame, is_diff):
+        """Write a decoded RGBA frame of a canvas into the mirrored region"""
+        canvas_details = self.canvas_details
+        if canvas_details is None:
+            # queued before the connection was lost
+            return
+        configuration = next(
+            c
+            for c in canvas_details["canvasConfigurations"]
+            if c["index"] == canvas_index
+        )
+        dx, dy = int(configuration["dx"]), int(configuration["dy"])
+
+        with self.lock:
+            x0, y0 = self.origin
+            # intersection of the frame and the mirrored region, in board coordinates
+            left, top = max(dx, x0), max(dy, y0)
+            right = min(dx + frame.shape[1], x0 + self.board.shape[1])
+            bottom = min(dy + frame.shape[0], y0 + self.board.shape[0])
+            if left >= right or top >= bottom:
+                # queued before the region moved off this canvas
+                return
+            frame = frame[top - dy : bottom - dy, left - dx : right - dx]
+            region = self.board[top - y0 : bottom - y0, left - x0 : right - x0]
+
+            if is_diff:
+                changed = frame[..., 3] != 0
+                region[changed] = diff.board_to_indices(
+                    frame[..., :3][changed], self.client.rgb_colors_array
+                )
+                self.client.heatmap.record(left, top, changed, region)
+            else:
+                region[...] = diff.board_to_indices(
+                    frame[..., :3], self.client.rgb_colors_array
+                )
+                self.received_canvases.add(canvas_index)
+
+            if all(c["index"] in self.received_canvases for c in self.canvases):
+                self.ready.set()
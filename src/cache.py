@@ -0,0 +1,35 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+def cache_key(*parts):
+    """Short stable hash of everything a cached result depends on"""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else repr(part).encode())
+        # so ("ab", "c") and ("a", "bc") never collide
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def cached_array(cache_dir, name, build):
+    """Load <cache_dir>/<name>.npy, calling build() and saving it on a miss"""
+    if cache_dir is None:
+        return build()
+
+    path = os.path.join(cache_dir, name + ".npy")
+    try:
+        return np.load(path)
+    except (OSError, ValueError):
+        pass
+
+    array = build()
+    os.makedirs(cache_dir, exist_ok=True)
+    # written under another name first, concurrent starts never read half a file
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+    return array
@@ -0,0 +1,73 @@
+from typing import NamedTuple
+
+import numpy as np
+
+from src.mappings import ColorMapper
+
+
+class BoardDiff(NamedTuple):
+    # True where the board differs from a non transparent template pixel, [y, x]
+    mask: np.ndarray
+    # (x, y) template coordinates of every wrong pixel, in row-major order
+    coords: np.ndarray
+    # percentage of non transparent template pixels already correct
+    completion: float
+
+
+def board_to_indices(board, rgb_colors_array: list):
+    """Map an array of RGB board colors to palette indices, colors outside the palette become TRANSPARENT_INDEX"""
+    rgb = np.asarray(board, dtype=np.uint32)
+    packed = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+    palette = np.asarray(rgb_colors_array, dtype=np.uint32)
+    palette_packed = (palette[:, 0] << 16) | (palette[:, 1] << 8) | palette[:, 2]
+    order = np.argsort(palette_packed)
+    sorted_packed = palette_packed[order]
+
+    positions = np.searchsorted(sorted_packed, packed).clip(0, len(order) - 1)
+    indices = order[positions].astype(np.uint8)
+    indices[sorted_packed[positions] != packed] = ColorMapper.TRANSPARENT_INDEX
+    return indices
+
+
+def diff_board(board_indices, template_indices, start_coords):
+    """Compare the template against the board region it is drawn on in one pass"""
+    x_start, y_start = start_coords
+    region = board_indices[
+        y_start : y_start + template_indices.shape[0],
+        x_start : x_start + template_indices.shape[1],
+    ]
+    # parts of the template hanging off the board can never be placed
+    template = template_indices[: region.shape[0], : region.shape[1]]
+
+    drawable = template != ColorMapper.TRANSPARENT_INDEX
+    mask = np.zeros(template_indices.shape, dtype=bool)
+    mask[: region.shape[0], : region.shape[1]] = drawable & (region != template)
+
+    ys, xs = np.nonzero(mask)
+    total = int(np.count_nonzero(drawable))
+    completion = 100.0 if total == 0 else 100.0 * (total - len(xs)) / total
+    return BoardDiff(mask, np.stack((xs, ys), axis=-1), completion)
+
+
+def changed_regions(old_indices, new_indices, tile_size=64):
+    """(x, y, width, height) rectangles covering every pixel that differs between two templates of the same size"""
+    changed = old_indices != new_indices
+    height, width = changed.shape
+    rows, columns = -(-height // tile_size), -(-width // tile_size)
+
+    padded = np.zeros((rows * tile_size, columns * tile_size), dtype=bool)
+    padded[:height, :width] = changed
+    tiles = padded.reshape(rows, tile_size, columns, tile_size).any(axis=(1, 3))
+
+    regions = []
+    for row in range(rows):
+        # neighbouring changed tiles of a row become one rectangle
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], tiles[row], [0]))))
+        y = row * tile_size
+        for start, end in zip(edges[::2].tolist(), edges[1::2].tolist()):
+            x = start * tile_size
+            regions.append(
+                (x, y, min(end * tile_size, width) - x, min(tile_size, height - y))
+            )
+    return regions
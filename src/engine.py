@@ -0,0 +1,120 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncEngine:
+    """Drives every worker as a coroutine on a single event loop.
+
+    Waiting for cooldowns costs a sleeping coroutine instead of an OS thread.
+    requests and websocket-client have no asyncio API, so every blocking step
+    (board sync, setPixel) runs in an executor that is never given more than
+    `concurrency` jobs at a time. Logins happen in the TokenRefresher pool.
+    """
+
+    def __init__(self, client, concurrency=32):
+        self.client = client
+        self.logger = client.logger
+        self.concurrency = concurrency
+
+        self.executor = None
+        self.semaphore = None
+
+    async def run_blocking(self, func, *args):
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, func, *args
+            )
+
+    def claim(self, index):
+        with self.client.profiler.span("get_unset_pixel", index):
+            pixel = self.client.scheduler.try_claim(index)
+        if pixel is not None:
+            x, y, color_index = pixel
+            self.client.journal.record(
+                "claim",
+                index,
+                x + self.client.pixel_x_start,
+                y + self.client.pixel_y_start,
+                color_index,
+            )
+        return pixel
+
+    async def turn(self, index, name, worker):
+        """One placement, returns the next allowed timestamp or None to stop"""
+        client = self.client
+
+        # tokens are renewed in the background, wait until this one is usable
+        loop = asyncio.get_running_loop()
+        resumed = asyncio.Event()
+        if client.token_refresher.hold(
+            index, lambda: loop.call_soon_threadsafe(resumed.set)
+        ):
+            await resumed.wait()
+        if index in client.token_refresher.failed:
+            return None
+
+        # claiming never blocks here, idle workers sleep on the event loop instead
+        pixel = await self.run_blocking(self.claim, index)
+        if pixel is None:
+            self.logger.info(
+                "Thread #{} : All pixels correct, trying again in {} seconds... ",
+                index,
+                client.scheduler.refresh_interval,
+            )
+            return time.time() + client.scheduler.refresh_interval
+
+        return await self.run_blocking(client.place_pixel, index, name, *pixel)
+
+    async def worker(self, index, name, worker):
+        self.client.metrics.active_workers.inc()
+        try:
+            await self.run_worker(index, name, worker)
+        finally:
+            self.client.metrics.active_workers.dec()
+
+    async def run_worker(self, index, name, worker):
+        # Stagger the first placement of every worker
+        await asyncio.sleep(index * self.client.delay_between_launches)
+
+        while True:
+            try:
+                next_pixel_placement_time = await self.turn(index, name, worker)
+            except SystemExit:
+                # like a worker thread calling exit(), only this worker stops
+                return
+            except Exception:
+                self.logger.exception(
+                    "Thread #{} - {}: Failed placing pixel, trying again in 30 seconds...",
+                    index,
+                    name,
+                )
+                next_pixel_placement_time = time.time() + 30
+
+            if (
+                next_pixel_placement_time is None
+                or not self.client.check_next_placement(
+                    index, name, next_pixel_placement_time
+                )
+            ):
+                return
+            await asyncio.sleep(max(0, next_pixel_placement_time - time.time()))
+
+    async def run(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        workers = self.client.json_data["workers"]
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as self.executor:
+            # token refresh, template reloads and the board mirror keep their own threads
+            self.client.token_refresher.start()
+            self.client.template_watcher.start()
+            self.client.board_mirror.start()
+            await asyncio.gather(
+                *(
+                    self.worker(index, name, workers[name])
+                    for index, name in enumerate(workers)
+                )
+            )
+
+    def start(self):
+        asyncio.run(self.run())
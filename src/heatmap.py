@@ -0,0 +1,87 @@
+import threading
+import time
+
+import numpy as np
+
+from src.mappings import ColorMapper
+
+# Counts are stored scaled up by 2 ** (age / half_life) instead of decaying
+# every pixel on every frame, they are rescaled once the scale reaches this
+MAX_SCALE = 2.0**64
+
+
+class OverwriteHeatmap:
+    """Decaying per-pixel count of how often others painted over the template.
+
+    Fed from the diff frames the board mirror already receives, so it costs no
+    extra requests. A pixel of a diff frame counts as an overwrite when it puts
+    a color other than the template's on a drawable template pixel. Counts halve
+    every `half_life` seconds.
+    """
+
+    def __init__(self, client, half_life=600):
+        self.client = client
+        self.half_life = half_life
+
+        self.lock = threading.Lock()
+        # [y, x] scaled counts in template coordinates
+        self.counts = None
+        # time at which the scale was 1
+        self.epoch = time.time()
+
+    def scale(self, now):
+        return 2.0 ** ((now - self.epoch) / self.half_life)
+
+    def reset(self):
+        with self.lock:
+            self.counts = None
+            self.epoch = time.time()
+
+    def record(self, x, y, changed, indices):
+        """Count the changed pixels of a diff frame at board (x, y) that no longer
+        match the template, `indices` holds the new colors"""
+        client = self.client
+        template = client.template_indices
+        # the frame in template coordinates, clipped to the template
+        left, top = x - client.pixel_x_start, y - client.pixel_y_start
+        x0, y0 = max(left, 0), max(top, 0)
+        x1 = min(left + changed.shape[1], template.shape[1])
+        y1 = min(top + changed.shape[0], template.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        target = template[y0:y1, x0:x1]
+        overwritten = (
+            changed[y0 - top : y1 - top, x0 - left : x1 - left]
+            & (target != ColorMapper.TRANSPARENT_INDEX)
+            & (indices[y0 - top : y1 - top, x0 - left : x1 - left] != target)
+        )
+        if not overwritten.any():
+            return
+
+        with self.lock:
+            now = time.time()
+            if self.counts is None or self.counts.shape != template.shape:
+                self.counts = np.zeros(template.shape, dtype=np.float32)
+                self.epoch = now
+            scale = self.scale(now)
+            if scale > MAX_SCALE:
+                self.counts /= np.float32(scale)
+                self.epoch = now
+                scale = 1.0
+            self.counts[y0:y1, x0:x1][overwritten] += np.float32(scale)
+
+    def snapshot(self):
+        """[y, x] decayed overwrite counts in template coordinates"""
+        template = self.client.template_indices
+        with self.lock:
+            if self.counts is None or self.counts.shape != template.shape:
+                return np.zeros(template.shape, dtype=np.float32)
+            return self.counts / np.float32(self.scale(time.time()))
+
+    def contested(self, snapshot=None, threshold=0.5):
+        """Number of template pixels with a decayed overwrite count of at least
+        `threshold`, counted in `snapshot` when one was already taken"""
+        if snapshot is None:
+            snapshot = self.snapshot()
+        return int(np.count_nonzero(snapshot >= threshold))
@@ -0,0 +1,55 @@
+import collections
+import threading
+import time
+
+
+class EventJournal:
+    """Ring buffer of the last `size` per-pixel events, enabled with --journal.
+
+    Events are stored as raw tuples and only formatted by dump(), so recording
+    one costs a deque append. While disabled record() returns right away. The
+    journal is dumped on SIGUSR1 and when the run ends.
+    """
+
+    def __init__(self, client, size=0):
+        self.client = client
+        self.logger = client.logger
+        self.lock = threading.Lock()
+        self.events = None
+        self.resize(size)
+
+    def resize(self, size):
+        self.events = collections.deque(maxlen=size) if size > 0 else None
+
+    def record(self, event, thread_index, *fields):
+        events = self.events
+        if events is None:
+            return
+        # deque.append is atomic, the oldest event falls out once full
+        events.append((time.time(), event, thread_index, fields))
+
+    def dump(self, path):
+        """Write the buffered events to `path`, oldest first"""
+        if self.events is None:
+            return
+        # SIGUSR1 can arrive while main() is already dumping on the same
+        # thread, blocking there would deadlock so the second dump is skipped
+        if not self.lock.acquire(blocking=False):
+            self.logger.info("Journal is already being written, skipping")
+            return
+        try:
+            events = list(self.events)
+            with open(path, "w") as f:
+                for timestamp, event, thread_index, fields in events:
+                    f.write(
+                        "{}.{:03d} Thread #{} {} {}\n".format(
+                            time.strftime("%H:%M:%S", time.localtime(timestamp)),
+                            int(timestamp * 1000) % 1000,
+                            thread_index,
+                            event,
+                            " ".join(str(field) for field in fields),
+                        )
+                    )
+        finally:
+            self.lock.release()
+        self.logger.info("Wrote {} journal events to {}", len(events), path)
@@ -1,6 +1,10 @@
 import math
+
+import numpy as np
 from PIL import ImageColor
 
+import src.cache as cache
+
 
 class ColorMapper:
     COLOR_MAP = {
@@ -38,6 +42,13 @@ class ColorMapper:
         "#FFFFFF": 31,  # white
     }
 
+    # palette index used in template arrays for pixels that must not be drawn
+    TRANSPARENT_INDEX = 255
+
+    # bits per channel of the closest color lookup table, 64**3 entries
+    LUT_BITS = 6
+    COLOR_METRICS = ("rgb", "weighted", "lab")
+
     # map of pixel color ids to verbose name (for debugging)
     NAME_MAP = {
         0: "Darkest Red",
@@ -114,3 +125,83 @@ class ColorMapper:
             ImageColor.getcolor(color_hex, "RGB")
             for color_hex in list(ColorMapper.COLOR_MAP.keys())
         ]
+
+    @staticmethod
+    def rgb_to_lab(rgb):
+        """Convert an array of sRGB colors (..., 3) in 0-255 to CIELAB (D65)"""
+        srgb = np.asarray(rgb, dtype=np.float64) / 255
+        linear = np.where(srgb > 0.04045, ((srgb + 0.055) / 1.055) ** 2.4, srgb / 12.92)
+        xyz = linear @ np.array(
+            [
+                [0.4124564, 0.2126729, 0.0193339],
+                [0.3575761, 0.7151522, 0.1191920],
+                [0.1804375, 0.0721750, 0.9503041],
+            ]
+        )
+        xyz /= np.array([0.95047, 1.0, 1.08883])
+        f = np.where(
+            xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29
+        )
+        return np.stack(
+            (
+                116 * f[..., 1] - 16,
+                500 * (f[..., 0] - f[..., 1]),
+                200 * (f[..., 1] - f[..., 2]),
+            ),
+            axis=-1,
+        )
+
+    @staticmethod
+    def color_distances(colors, rgb_colors_array: list, metric: str):
+        """Distance (or a monotonic function of it) from every color to every palette color"""
+        colors = np.asarray(colors, dtype=np.float64)[..., None, :]
+        palette = np.asarray(rgb_colors_array, dtype=np.float64)
+        if metric == "rgb":
+            return ((colors - palette) ** 2).sum(axis=-1)
+        if metric == "weighted":
+            # "redmean" approximation of perceived distance
+            red_mean = (colors[..., 0] + palette[:, 0]) / 2
+            diffs = (colors - palette) ** 2
+            return (
+                (2 + red_mean / 256) * diffs[..., 0]
+                + 4 * diffs[..., 1]
+                + (2 + (255 - red_mean) / 256) * diffs[..., 2]
+            )
+        if metric == "lab":
+            lab_diffs = ColorMapper.rgb_to_lab(colors) - ColorMapper.rgb_to_lab(palette)
+            return (lab_diffs**2).sum(axis=-1)
+        raise ValueError("Unknown color metric: {}".format(metric))
+
+    @staticmethod
+    def build_lut(rgb_colors_array: list, metric: str = "rgb"):
+        """Closest palette index of every color, quantized to LUT_BITS per channel"""
+        levels = 1 << ColorMapper.LUT_BITS
+        step = 256 // levels
+        # every bucket is represented by its center
+        channel = np.arange(levels) * step + step // 2
+        r, g, b = np.meshgrid(channel, channel, channel, indexing="ij")
+        colors = np.stack((r, g, b), axis=-1).reshape(-1, 3)
+
+        lut = np.empty(len(colors), dtype=np.uint8)
+        # bounded memory for the (colors, palette, channels) intermediate arrays
+        chunk = 16384
+        for start in range(0, len(colors), chunk):
+            lut[start : start + chunk] = np.argmin(
+                ColorMapper.color_distances(
+                    colors[start : start + chunk], rgb_colors_array, metric
+                ),
+                axis=-1,
+            )
+        return lut.reshape(levels, levels, levels)
+
+    @staticmethod
+    def load_lut(rgb_colors_array: list, metric: str = "rgb", cache_dir=None):
+        """build_lut, cached in cache_dir keyed by the palette and metric"""
+        return cache.cached_array(
+            cache_dir,
+            "lut-{}-{}".format(
+                metric,
+                cache.cache_key(list(rgb_colors_array), metric, ColorMapper.LUT_BITS),
+            ),
+            lambda: ColorMapper.build_lut(rgb_colors_array, metric),
+        )
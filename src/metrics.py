@@ -0,0 +1,203 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import src.auth as auth
+
+# Upper bounds in seconds, from a quick setPixel to a login stuck on retries
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} counter".format(self.name),
+            "{} {}".format(self.name, self.value),
+        ]
+
+
+class Gauge:
+    """Value that goes up and down, or is read from `function` on every scrape"""
+
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def render(self):
+        value = self.value if self.function is None else self.function()
+        return [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} gauge".format(self.name),
+            "{} {}".format(self.name, value),
+        ]
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(float(bound) for bound in buckets)
+        self.lock = threading.Lock()
+        # observations per bucket, the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # a value equal to a bound belongs to that bucket
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(
+                '{}_bucket{{le="{}"}} {}'.format(
+                    self.name, "+Inf" if bound == float("inf") else bound, cumulative
+                )
+            )
+        lines.append("{}_sum {}".format(self.name, total))
+        lines.append("{}_count {}".format(self.name, cumulative))
+        return lines
+
+
+class Metrics:
+    """Counters and timings of the placement and board pipeline.
+
+    Always collected, an observation costs a lock and an addition. serve()
+    exposes them over HTTP in the Prometheus text format at /metrics.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.logger = client.logger
+        self.server = None
+
+        self.placements = Counter(
+            "rplace_placements_total", "Pixels placed successfully"
+        )
+        self.rate_limited = Counter(
+            "rplace_rate_limited_total", "Placements rejected by the rate limit"
+        )
+        self.set_pixel_seconds = Histogram(
+            "rplace_set_pixel_seconds", "Round trip of the setPixel request"
+        )
+        self.get_board_seconds = Histogram(
+            "rplace_get_board_seconds",
+            "Time to read the board, including waiting for the first frames",
+        )
+        self.frame_decode_seconds = Histogram(
+            "rplace_frame_decode_seconds", "PNG decoding of a full or diff frame"
+        )
+        self.login_seconds = Histogram(
+            "rplace_login_seconds", "Login of a worker, up to a new access token"
+        )
+        self.active_workers = Gauge(
+            "rplace_active_workers", "Workers that have not stopped"
+        )
+        self.expiring_tokens = Gauge(
+            "rplace_expiring_tokens",
+            "Access tokens that are expired or due to be renewed",
+            self.count_expiring_tokens,
+        )
+        self.template_completion = Gauge(
+            "rplace_template_completion_percent",
+            "Share of template pixels that are correct on the board",
+            lambda: client.scheduler.completion,
+        )
+        self.contested_pixels = Gauge(
+            "rplace_contested_pixels",
+            "Template pixels others painted over recently, see heatmap_half_life",
+            lambda: client.scheduler.contested,
+        )
+
+    def count_expiring_tokens(self):
+        renew_from = time.time() + auth.TokenRefresher.REFRESH_AHEAD
+        # copied, logins update the dict from other threads
+        expires_at = list(self.client.access_token_expires_at_timestamp.values())
+        return sum(1 for timestamp in expires_at if timestamp <= renew_from)
+
+    def render(self):
+        lines = []
+        for metric in (
+            self.placements,
+            self.rate_limited,
+            self.set_pixel_seconds,
+            self.get_board_seconds,
+            self.frame_decode_seconds,
+            self.login_seconds,
+            self.active_workers,
+            self.expiring_tokens,
+            self.template_completion,
+            self.contested_pixels,
+        ):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host, port):
+        """Answer scrapes from a background thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.logger.info(
+            "Serving metrics on http://{}:{}/metrics",
+            host,
+            self.server.server_address[1],
+        )
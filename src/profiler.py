@@ -0,0 +1,140 @@
+import collections
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# handed out while profiling is off, entering it does nothing
+NULL_SPAN = nullcontext()
+
+# spans kept for the trace, roughly 150 MB, the oldest are dropped after that
+MAX_EVENTS = 1_000_000
+
+
+class Span:
+    __slots__ = ("profiler", "name", "thread_index", "start")
+
+    def __init__(self, profiler, name, thread_index):
+        self.profiler = profiler
+        self.name = name
+        self.thread_index = thread_index
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        thread_index = self.thread_index
+        if thread_index is None:
+            thread_index = threading.current_thread().name
+        # deque.append is atomic, spans end on many threads at once
+        self.profiler.events.append((self.name, thread_index, self.start, end))
+
+
+class Profiler:
+    """Timing spans around the stages of the client, enabled with --profile.
+
+    Spans are tagged with the worker's thread index, or the name of the thread
+    for the board mirror and other background work. The last MAX_EVENTS spans
+    are kept until write() turns them into a summary and a trace in the Chrome
+    trace event format, which chrome://tracing and https://ui.perfetto.dev
+    open. On longer runs both cover the most recent spans only.
+
+    While disabled span() returns a shared no-op context manager, so the
+    instrumentation costs a method call.
+    """
+
+    def __init__(self, client, enabled=False):
+        self.client = client
+        self.logger = client.logger
+        self.enabled = enabled
+        # (name, thread index or thread name, start ns, end ns)
+        self.events = collections.deque(maxlen=MAX_EVENTS)
+        self.started_at = time.perf_counter_ns()
+
+    def span(self, name, thread_index=None):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, thread_index)
+
+    def summary(self):
+        """Rows of (stage, calls, total s, mean ms, p50 ms, p95 ms, max ms)"""
+        durations = {}
+        for name, _, start, end in list(self.events):
+            durations.setdefault(name, []).append((end - start) / 1e6)
+
+        rows = []
+        for name, values in durations.items():
+            values.sort()
+            rows.append(
+                (
+                    name,
+                    len(values),
+                    sum(values) / 1e3,
+                    sum(values) / len(values),
+                    values[len(values) // 2],
+                    values[min(int(len(values) * 0.95), len(values) - 1)],
+                    values[-1],
+                )
+            )
+        # where the time went first
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def write(self, trace_path):
+        """Log the summary and write the trace file"""
+        lines = [
+            "{:<32} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+                "stage", "calls", "total s", "mean ms", "p50 ms", "p95 ms", "max ms"
+            )
+        ]
+        for row in self.summary():
+            lines.append(
+                "{:<32} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                    *row
+                )
+            )
+        self.logger.info(
+            "Profile of {:.1f} seconds:\n{}",
+            (time.perf_counter_ns() - self.started_at) / 1e9,
+            "\n".join(lines),
+        )
+
+        pid = os.getpid()
+        # the trace viewer wants numeric thread ids, named by metadata events
+        thread_ids = {}
+        trace_events = []
+        for name, thread_index, start, end in list(self.events):
+            if thread_index not in thread_ids:
+                thread_ids[thread_index] = len(thread_ids)
+                trace_events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": pid,
+                        "tid": thread_ids[thread_index],
+                        "args": {
+                            "name": (
+                                "Thread #{}".format(thread_index)
+                                if isinstance(thread_index, int)
+                                else thread_index
+                            )
+                        },
+                    }
+                )
+            trace_events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "pid": pid,
+                    "tid": thread_ids[thread_index],
+                    # microseconds since the profiler was created
+                    "ts": (start - self.started_at) / 1e3,
+                    "dur": (end - start) / 1e3,
+                }
+            )
+
+        with open(trace_path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+        self.logger.info("Trace written to {}", trace_path)
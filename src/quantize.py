@@ -0,0 +1,125 @@
+import numpy as np
+
+from src.mappings import ColorMapper
+
+DITHERING_METHODS = ("nearest", "ordered", "floyd-steinberg")
+
+# 8x8 Bayer threshold matrix, values 0-63
+BAYER_MATRIX = np.array(
+    [
+        [0, 32, 8, 40, 2, 34, 10, 42],
+        [48, 16, 56, 24, 50, 18, 58, 26],
+        [12, 44, 4, 36, 14, 46, 6, 38],
+        [60, 28, 52, 20, 62, 30, 54, 22],
+        [3, 35, 11, 43, 1, 33, 9, 41],
+        [51, 19, 59, 27, 49, 17, 57, 25],
+        [15, 47, 7, 39, 13, 45, 5, 37],
+        [63, 31, 55, 23, 61, 29, 53, 21],
+    ]
+)
+# How far ordered dithering may push a channel, roughly the gap between
+# neighbouring palette colors
+ORDERED_SPREAD = 48
+
+
+def transparency_mask(rgba, legacy_transparency: bool):
+    """Pixels that must not be drawn, same rules as ColorMapper.closest_color"""
+    mask = rgba[..., 3] == 0
+    if legacy_transparency:
+        mask |= (rgba[..., 0] == 69) & (rgba[..., 1] == 42) & (rgba[..., 2] == 0)
+    return mask
+
+
+def lookup(lut, rgb):
+    shift = 8 - ColorMapper.LUT_BITS
+    return lut[rgb[..., 0] >> shift, rgb[..., 1] >> shift, rgb[..., 2] >> shift]
+
+
+def ordered(rgba, lut):
+    height, width = rgba.shape[:2]
+    threshold = BAYER_MATRIX[np.arange(height)[:, None] % 8, np.arange(width) % 8]
+    offset = ((threshold + 0.5) / 64 - 0.5) * ORDERED_SPREAD
+    rgb = np.clip(rgba[..., :3] + offset[..., None], 0, 255).astype(np.uint8)
+    return lookup(lut, rgb)
+
+
+def floyd_steinberg(rgba, lut, rgb_colors_array, transparent):
+    """Error diffusion, the error never crosses transparent pixels.
+
+    Every pixel depends on the error of the ones before it, so this cannot be
+    vectorized. It runs on plain lists and floats, indexing NumPy arrays one
+    element at a time is several times slower.
+    """
+    height, width = rgba.shape[:2]
+    palette = [tuple(float(c) for c in color) for color in rgb_colors_array]
+    shift = 8 - ColorMapper.LUT_BITS
+    bits = ColorMapper.LUT_BITS
+    flat_lut = lut.ravel().tolist()
+    # one row of [r, g, b, r, g, b, ...] being quantized and the next one
+    # collecting its error
+    rows = rgba[..., :3].astype(np.float64).reshape(height, width * 3).tolist()
+    skip = transparent.tolist()
+    indices = np.empty((height, width), dtype=np.uint8)
+
+    for y in range(height):
+        row = rows[y]
+        row_skip = skip[y]
+        below = rows[y + 1] if y + 1 < height else None
+        below_skip = skip[y + 1] if below is not None else None
+        out = [0] * width
+        for x in range(width):
+            if row_skip[x]:
+                continue
+            i = x * 3
+            r, g, b = row[i], row[i + 1], row[i + 2]
+            # same bucket as lut[r >> shift, g >> shift, b >> shift]
+            index = flat_lut[
+                (min(max(int(r), 0), 255) >> shift) << (2 * bits)
+                | (min(max(int(g), 0), 255) >> shift) << bits
+                | (min(max(int(b), 0), 255) >> shift)
+            ]
+            out[x] = index
+            color = palette[index]
+            er = r - color[0]
+            eg = g - color[1]
+            eb = b - color[2]
+
+            if x + 1 < width and not row_skip[x + 1]:
+                row[i + 3] += er * (7 / 16)
+                row[i + 4] += eg * (7 / 16)
+                row[i + 5] += eb * (7 / 16)
+            if below is not None:
+                if x > 0 and not below_skip[x - 1]:
+                    below[i - 3] += er * (3 / 16)
+                    below[i - 2] += eg * (3 / 16)
+                    below[i - 1] += eb * (3 / 16)
+                if not below_skip[x]:
+                    below[i] += er * (5 / 16)
+                    below[i + 1] += eg * (5 / 16)
+                    below[i + 2] += eb * (5 / 16)
+                if x + 1 < width and not below_skip[x + 1]:
+                    below[i + 3] += er * (1 / 16)
+                    below[i + 4] += eg * (1 / 16)
+                    below[i + 5] += eb * (1 / 16)
+        indices[y] = out
+    return indices
+
+
+def quantize(image, rgb_colors_array, legacy_transparency, method="nearest", lut=None):
+    """Palette indices of an image, TRANSPARENT_INDEX where nothing is drawn"""
+    if lut is None:
+        lut = ColorMapper.load_lut(rgb_colors_array)
+    rgba = np.asarray(image.convert("RGBA"), dtype=np.uint8)
+    transparent = transparency_mask(rgba, legacy_transparency)
+
+    if method == "nearest":
+        indices = lookup(lut, rgba)
+    elif method == "ordered":
+        indices = ordered(rgba, lut)
+    elif method == "floyd-steinberg":
+        indices = floyd_steinberg(rgba, lut, rgb_colors_array, transparent)
+    else:
+        raise ValueError("Unknown dithering method: {}".format(method))
+
+    indices[transparent] = ColorMapper.TRANSPARENT_INDEX
+    return indices
@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+
+import src.diff as diff
+import src.utils as utils
+
+
+class TemplateWatcher:
+    """Reloads the templates when config.json or an image changes, without a restart.
+
+    Files are polled by modification time. The image paths, coordinates,
+    priorities and the dithering, color_metric, legacy_transparency and
+    repair_strategy options are reloaded. When only pixels of the template
+    changed, the scheduler re-diffs just the tiles that differ; a new position
+    or size resets it and moves the board mirror to the new region. Workers,
+    their cooldowns and their tokens are left alone.
+    """
+
+    def __init__(self, client, interval=5):
+        self.client = client
+        self.logger = client.logger
+        # In seconds, None disables reloading
+        self.interval = interval
+
+        self.thread = None
+        # path -> modification time when the template was last loaded
+        self.seen = {}
+
+    def paths(self):
+        client = self.client
+        paths = [client.config_path]
+        paths += [spec["image_path"] for spec in client.template_specs]
+        # grayscale priority images, "alpha" comes with the image itself
+        paths += [
+            spec["priority_mask"]
+            for spec in client.template_specs
+            if spec["priority_mask"] not in (None, "alpha")
+        ]
+        if client.compiled_template_path is not None:
+            paths.append(client.compiled_template_path)
+        return paths
+
+    def modification_times(self):
+        times = {}
+        for path in self.paths():
+            try:
+                times[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                times[path] = None
+        return times
+
+    def start(self):
+        if self.interval is None or self.thread is not None:
+            return
+        self.seen = self.modification_times()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            current = self.modification_times()
+            if current == self.seen:
+                continue
+            # a half written file changes again once it is complete
+            self.seen = current
+            try:
+                self.reload()
+            except (Exception, SystemExit):
+                self.logger.exception("Failed to reload template, keeping the old one")
+
+    def reload(self):
+        client = self.client
+        json_data = utils.get_json_data(client, client.config_path)
+        specs = utils.get_template_specs(json_data)
+        compiled_template_path = (
+            json_data["compiled_template"] if "compiled_template" in json_data else None
+        )
+        settings = utils.get_template_settings(json_data)
+        previous_settings = {name: getattr(client, name) for name in settings}
+        # only the watcher thread builds templates, so the settings can be swapped
+        # in for the build and restored if it fails
+        utils.set_template_settings(client, settings)
+        try:
+            origin, indices, priority, order = utils.load_templates(
+                client, specs, compiled_template_path
+            )
+        except BaseException:
+            utils.set_template_settings(client, previous_settings)
+            raise
+
+        moved = (
+            origin != (client.pixel_x_start, client.pixel_y_start)
+            or indices.shape != client.template_indices.shape
+        )
+        regions = (
+            None if moved else diff.changed_regions(client.template_indices, indices)
+        )
+        # read outside the scheduler lock, workers go on while the mirror re-syncs
+        board = None if moved or len(regions) == 0 else client.get_board()
+
+        # workers claim pixels under the same lock, they never see half a swap
+        with client.scheduler.condition:
+            client.template_specs = specs
+            client.compiled_template_path = compiled_template_path
+            client.pixel_x_start, client.pixel_y_start = origin
+            client.template_indices = indices
+            client.template_priority = priority
+            client.template_order = order
+            client.image_size = (indices.shape[1], indices.shape[0])
+            if moved:
+                # counts of the old position say nothing about the new one
+                client.heatmap.reset()
+                client.board_mirror.set_region(
+                    (
+                        origin[0],
+                        origin[1],
+                        origin[0] + indices.shape[1],
+                        origin[1] + indices.shape[0],
+                    )
+                )
+            client.scheduler.rediff(regions, board)
+
+        # the config may point to other files now
+        self.seen = self.modification_times()
+        if moved:
+            self.logger.info(
+                "Reloaded {} templates at {}, {} size: {}",
+                len(specs),
+                origin[0],
+                origin[1],
+                client.image_size,
+            )
+        else:
+            self.logger.info(
+                "Reloaded {} templates, {} regions changed", len(specs), len(regions)
+            )
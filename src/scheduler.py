@@ -0,0 +1,211 @@
+import heapq
+import threading
+import time
+
+import numpy as np
+
+import src.diff as diff
+
+
+class PixelScheduler:
+    """Hands out every wrong template pixel to at most one worker at a time.
+
+    Pending pixels are kept in a heap of ranks, a pixel's place in the
+    template's repair order, so the most important wrong pixel is always the
+    next one out in O(log n). Among equally important pixels, those others keep
+    painting over, according to the client's heatmap, come first. A claimed pixel is leased: it is not handed out
+    again until the placement is released or the lease runs out.
+    """
+
+    def __init__(self, client, refresh_interval=10, lease_duration=60, grace=30):
+        self.client = client
+        self.logger = client.logger
+
+        # In seconds
+        self.refresh_interval = refresh_interval
+        self.lease_duration = lease_duration
+        # placed pixels stay leased until the board mirror has caught up
+        self.grace = grace
+
+        self.condition = threading.Condition()
+        # heap of the ranks of wrong pixels that are not leased
+        self.pending = []
+        # the same ranks, for membership tests
+        self.queued = set()
+        # position -> timestamp at which the lease expires
+        self.leases = {}
+        self.refreshed_at = 0
+        self.completion = 0.0
+        # template pixels painted over recently, as of the last refresh
+        self.contested = 0
+        # bumped whenever the template moves or is resized, boards read for the
+        # previous one are then thrown away
+        self.generation = 0
+
+        # repair order the ranks refer to and its inverse, position -> rank
+        self.order = None
+        self.ranks = None
+        self.load_order()
+
+    def width(self):
+        return self.client.template_indices.shape[1]
+
+    def load_order(self, heat=None):
+        """Take the template's repair order, moving pixels that are painted over
+        ahead of equally important ones when the heatmap `heat` is given"""
+        order = np.asarray(self.client.template_order, dtype=np.int64)
+        if heat is not None:
+            # decayed overwrite counts rounded, a pixel hit once a half-life ago
+            # still counts as 1
+            overwrites = np.minimum(np.floor(heat.ravel()[order] + 0.5), 255)
+            if overwrites.any():
+                priority = self.client.template_priority.ravel()[order]
+                # priority, overwrites and the current rank packed into one
+                # unique key, the rank keeps the strategy's order among the rest
+                bits = max(len(order), 1).bit_length()
+                key = (
+                    ((0xFFFF - priority.astype(np.int64)) << (bits + 8))
+                    | ((255 - overwrites.astype(np.int64)) << bits)
+                    | np.arange(len(order), dtype=np.int64)
+                )
+                order = order[np.argsort(key)]
+        self.order = order
+        self.ranks = np.zeros(self.client.template_indices.size, dtype=np.int64)
+        self.ranks[self.order] = np.arange(len(self.order))
+
+    def queue(self, positions):
+        """Replace the queue with the positions that are not leased"""
+        positions = positions[~np.isin(positions, list(self.leases))]
+        # a sorted list is a valid heap
+        self.pending = np.sort(self.ranks[positions]).tolist()
+        self.queued = set(self.pending)
+
+    def refresh(self, now, board):
+        """Rebuild the pending queue from `board`, skipping leased pixels"""
+        # the board region starts at the template's top left corner
+        board_diff = diff.diff_board(board, self.client.template_indices, (0, 0))
+
+        self.leases = {
+            position: expires_at
+            for position, expires_at in self.leases.items()
+            if expires_at > now
+        }
+        heat = self.client.heatmap.snapshot()
+        self.load_order(heat)
+        self.queue(board_diff.coords[:, 1] * self.width() + board_diff.coords[:, 0])
+        self.refreshed_at = now
+        self.completion = board_diff.completion
+        self.contested = self.client.heatmap.contested(heat)
+        self.logger.info(
+            "Template {:.2f}% complete, {} pixels queued, {} leased, {} contested",
+            self.completion,
+            len(self.queued),
+            len(self.leases),
+            self.contested,
+        )
+
+    def try_claim(self, index):
+        """Lease the most important wrong pixel to the worker, None if every pixel is correct"""
+        while True:
+            # get_board() waits while the mirror re-syncs, which must not hold
+            # up release() and the other workers, so it is read without the lock
+            generation = self.generation
+            board = None
+            if time.time() - self.refreshed_at >= self.refresh_interval:
+                board = self.client.get_board(index)
+
+            with self.condition:
+                now = time.time()
+                if now - self.refreshed_at >= self.refresh_interval:
+                    if board is None or generation != self.generation:
+                        # the board was not read or belongs to the old template
+                        continue
+                    self.refresh(now, board)
+
+                if len(self.pending) == 0:
+                    return None
+                rank = heapq.heappop(self.pending)
+                self.queued.remove(rank)
+
+                position = int(self.order[rank])
+                self.leases[position] = now + self.lease_duration
+                x, y = position % self.width(), position // self.width()
+                return x, y, int(self.client.template_indices[y, x])
+
+    def claim(self, index):
+        """Block until a wrong pixel is available and lease it to the worker"""
+        while True:
+            pixel = self.try_claim(index)
+            if pixel is not None:
+                return pixel
+
+            self.logger.info(
+                "Thread #{} : All pixels correct, trying again in {} seconds... ",
+                index,
+                self.refresh_interval,
+            )
+            with self.condition:
+                # woken early if a failed placement puts a pixel back
+                if len(self.pending) == 0:
+                    self.condition.wait(self.refresh_interval)
+
+    def release(self, x, y, placed):
+        """End the lease on a pixel, requeueing it if the placement failed"""
+        position = y * self.width() + x
+        with self.condition:
+            if placed:
+                self.leases[position] = time.time() + self.grace
+                return
+            self.leases.pop(position, None)
+            rank = int(self.ranks[position])
+            if rank not in self.queued:
+                heapq.heappush(self.pending, rank)
+                self.queued.add(rank)
+            self.condition.notify()
+
+    def rediff(self, regions, board=None):
+        """Recompute the pending pixels inside (x, y, width, height) regions of a
+        replaced template, read from `board`, None when its size or position changed"""
+        with self.condition:
+            if regions is None:
+                # positions of the old template mean nothing anymore
+                self.pending = []
+                self.queued = set()
+                self.leases = {}
+                self.refreshed_at = 0
+                self.generation += 1
+                self.load_order()
+                self.condition.notify_all()
+                return
+
+            width = self.width()
+            positions = self.order[sorted(self.queued)]
+            xs, ys = positions % width, positions // width
+            keep = np.ones(len(positions), dtype=bool)
+            added = []
+            template = self.client.template_indices
+            for x, y, region_width, region_height in regions:
+                keep &= ~(
+                    (xs >= x)
+                    & (xs < x + region_width)
+                    & (ys >= y)
+                    & (ys < y + region_height)
+                )
+
+                board_diff = diff.diff_board(
+                    board[y : y + region_height, x : x + region_width],
+                    template[y : y + region_height, x : x + region_width],
+                    (0, 0),
+                )
+                added.append(
+                    (board_diff.coords[:, 1] + y) * width
+                    + (board_diff.coords[:, 0] + x)
+                )
+
+            # the repair order may have changed even where the colors did not
+            self.load_order(self.client.heatmap.snapshot())
+            self.queue(np.concatenate([positions[keep]] + added))
+            self.logger.debug(
+                "Re-diffed {} regions, {} pixels queued", len(regions), len(self.queued)
+            )
+            self.condition.notify_all()
@@ -0,0 +1,186 @@
+import json
+import os
+import struct
+from typing import NamedTuple
+
+import numpy as np
+
+from src.mappings import ColorMapper
+
+# File layout: MAGIC, little endian u32 header length, JSON header, then the
+# sections at the offsets listed in the header, each aligned to SECTION_ALIGNMENT
+MAGIC = b"RPLTMPL3"
+SECTION_ALIGNMENT = 64
+
+REPAIR_STRATEGIES = ("raster", "edges", "random", "spiral")
+
+
+class CompiledTemplate(NamedTuple):
+    # (x, y) of the top left pixel on the board
+    origin: tuple
+    # [y, x] palette indices, TRANSPARENT_INDEX where nothing is drawn
+    indices: np.ndarray
+    # [y, x] True where nothing is drawn
+    transparent: np.ndarray
+    # [y, x] priority of the template each pixel was taken from in the high
+    # byte, the pixel's own priority in the low byte
+    priority: np.ndarray
+    # row-major positions (y * width + x) of drawable pixels, most important first
+    order: np.ndarray
+    # cache key of the image and options the template was compiled from
+    source_key: str
+
+
+def default_order(indices):
+    return np.flatnonzero(indices != ColorMapper.TRANSPARENT_INDEX).astype(np.uint32)
+
+
+def edge_mask(indices):
+    """[y, x] True where a 4-neighbour has another color or nothing is drawn"""
+    padded = np.pad(indices, 1, constant_values=ColorMapper.TRANSPARENT_INDEX)
+    center = padded[1:-1, 1:-1]
+    return (
+        (center != padded[:-2, 1:-1])
+        | (center != padded[2:, 1:-1])
+        | (center != padded[1:-1, :-2])
+        | (center != padded[1:-1, 2:])
+    )
+
+
+def repair_order(indices, priority, strategy="raster"):
+    """Row-major positions of drawable pixels, highest priority first, ties broken
+    by the strategy and then by raster order"""
+    height, width = indices.shape
+    positions = default_order(indices)
+    ys, xs = np.divmod(positions.astype(np.int64), width)
+
+    if strategy == "raster":
+        keys = ()
+    elif strategy == "edges":
+        # outlines and color boundaries are what the artwork is recognized by
+        keys = (~edge_mask(indices).ravel()[positions],)
+    elif strategy == "random":
+        # fixed seed, every start and every compile gives the same order
+        keys = (np.random.default_rng(0).permutation(len(positions)),)
+    elif strategy == "spiral":
+        dy, dx = ys - (height - 1) / 2, xs - (width - 1) / 2
+        ring = np.floor(np.maximum(np.abs(dy), np.abs(dx)))
+        keys = (np.arctan2(dy, dx), ring)
+    else:
+        raise ValueError("Unknown repair strategy: {}".format(strategy))
+
+    # lexsort is stable and sorts by its last key first
+    importance = -priority.ravel()[positions].astype(np.int32)
+    return positions[np.lexsort(keys + (importance,))]
+
+
+def composite(layers):
+    """Merge (origin, indices, priority, pixel priority) templates into one target
+    and priority layer, pixel priority may be None.
+
+    Where templates overlap the higher priority wins, the earlier one on a tie.
+    """
+    x0 = min(origin[0] for origin, *_ in layers)
+    y0 = min(origin[1] for origin, *_ in layers)
+    x1 = max(origin[0] + indices.shape[1] for origin, indices, *_ in layers)
+    y1 = max(origin[1] + indices.shape[0] for origin, indices, *_ in layers)
+
+    target = np.full((y1 - y0, x1 - x0), ColorMapper.TRANSPARENT_INDEX, np.uint8)
+    priority = np.zeros(target.shape, dtype=np.uint16)
+    # painted from least to most important, the winner ends up on top
+    for i in sorted(range(len(layers)), key=lambda i: (layers[i][2], -i)):
+        (x, y), indices, layer_priority, pixel_priority = layers[i]
+        layer = np.full(indices.shape, layer_priority << 8, dtype=np.uint16)
+        if pixel_priority is not None:
+            layer |= pixel_priority
+        drawable = indices != ColorMapper.TRANSPARENT_INDEX
+        top, left = y - y0, x - x0
+        height, width = indices.shape
+        target[top : top + height, left : left + width][drawable] = indices[drawable]
+        priority[top : top + height, left : left + width][drawable] = layer[drawable]
+    return (x0, y0), target, priority
+
+
+def write_template(path, origin, indices, source_key, order=None, priority=None):
+    """Write a template artifact that read_template can memory map"""
+    if order is None:
+        order = default_order(indices)
+    if priority is None:
+        priority = np.zeros(indices.shape, dtype=np.uint16)
+    sections = [
+        ("indices", np.ascontiguousarray(indices, dtype=np.uint8)),
+        (
+            "transparent",
+            np.ascontiguousarray(indices == ColorMapper.TRANSPARENT_INDEX, np.uint8),
+        ),
+        ("priority", np.ascontiguousarray(priority, dtype="<u2")),
+        ("order", np.ascontiguousarray(order, dtype=np.uint32)),
+    ]
+
+    header = {
+        "origin": list(origin),
+        "width": int(indices.shape[1]),
+        "height": int(indices.shape[0]),
+        "order_length": int(len(order)),
+        "source_key": source_key,
+        "sections": {},
+    }
+    # offsets depend on the header length, which depends on the offsets:
+    # reserve enough digits for every offset up front
+    offset = len(MAGIC) + 4 + len(json.dumps(header)) + 64 * len(sections)
+    for name, array in sections:
+        offset += -offset % SECTION_ALIGNMENT
+        header["sections"][name] = offset
+        offset += array.nbytes
+    header_bytes = json.dumps(header).encode()
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in sections:
+            f.write(b"\0" * (header["sections"][name] - f.tell()))
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_template(path):
+    """Memory map a template artifact, pages are shared by every process using it"""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(
+                "{} is not a compiled template of this version, run compile again".format(
+                    path
+                )
+            )
+        (header_length,) = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(header_length))
+
+    shape = (header["height"], header["width"])
+    sections = header["sections"]
+    return CompiledTemplate(
+        origin=tuple(header["origin"]),
+        indices=np.memmap(
+            path, dtype=np.uint8, mode="r", offset=sections["indices"], shape=shape
+        ),
+        transparent=np.memmap(
+            path, dtype=np.bool_, mode="r", offset=sections["transparent"], shape=shape
+        ),
+        priority=np.memmap(
+            path, dtype="<u2", mode="r", offset=sections["priority"], shape=shape
+        ),
+        # numpy cannot map zero bytes
+        order=(
+            np.memmap(
+                path,
+                dtype=np.uint32,
+                mode="r",
+                offset=sections["order"],
+                shape=(header["order_length"],),
+            )
+            if header["order_length"] > 0
+            else np.empty(0, dtype=np.uint32)
+        ),
+        source_key=header["source_key"],
+    )
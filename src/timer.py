@@ -0,0 +1,48 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class CooldownTimer:
+    """Min-heap of worker cooldown deadlines.
+
+    The dispatcher sleeps until the earliest deadline instead of every worker
+    waking up once a second, then gets back exactly the workers that are due.
+    A worker is active from its first schedule() until retire() is called.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        # tie-breaker so workers with the same deadline are never compared
+        self.counter = itertools.count()
+        self.active = set()
+
+    def schedule(self, key, deadline):
+        with self.condition:
+            self.active.add(key)
+            heapq.heappush(self.heap, (deadline, next(self.counter), key))
+            # the dispatcher only needs to wake up if the earliest deadline changed
+            if self.heap[0][2] == key:
+                self.condition.notify()
+
+    def retire(self, key):
+        with self.condition:
+            self.active.discard(key)
+            self.condition.notify()
+
+    def wait_due(self):
+        """Block until a deadline passes, returns [] once no worker is active"""
+        with self.condition:
+            while len(self.active) > 0:
+                now = time.time()
+                if len(self.heap) > 0 and self.heap[0][0] <= now:
+                    due = []
+                    while len(self.heap) > 0 and self.heap[0][0] <= now:
+                        due.append(heapq.heappop(self.heap)[2])
+                    return due
+                self.condition.wait(
+                    None if len(self.heap) == 0 else self.heap[0][0] - now
+                )
+            return []
@@ -0,0 +1,97 @@
+import json
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import src.proxy as proxy
+
+# Where every request goes, "endpoints" in config.json overrides them, e.g. to
+# point the client at benchmarks/fake_place.py
+DEFAULT_ENDPOINTS = {
+    "login": "https://www.reddit.com/login",
+    "session": "https://new.reddit.com/",
+    "gql": "https://gql-realtime-2.reddit.com/query",
+    "websocket": "wss://gql-realtime-2.reddit.com/query",
+}
+
+SET_PIXEL_QUERY = "mutation setPixel($input: ActInput!) {\n  act(input: $input) {\n    data {\n      ... on BasicMessage {\n        id\n        data {\n          ... on GetUserCooldownResponseMessageData {\n            nextAvailablePixelTimestamp\n            __typename\n          }\n          ... on SetPixelResponseMessageData {\n            timestamp\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n"
+
+# Serialized once, only the four integers change between placements.
+# The query contains no "%" so it is safe to use as a format string.
+SET_PIXEL_PAYLOAD = (
+    json.dumps(
+        {
+            "operationName": "setPixel",
+            "variables": {
+                "input": {
+                    "actionName": "r/replace:set_pixel",
+                    "PixelMessageData": {
+                        "coordinate": {"x": "%(x)d", "y": "%(y)d"},
+                        "colorIndex": "%(color_index)d",
+                        "canvasIndex": "%(canvas_index)d",
+                    },
+                }
+            },
+            "query": SET_PIXEL_QUERY,
+        }
+    )
+    .replace('"%(x)d"', "%(x)d")
+    .replace('"%(y)d"', "%(y)d")
+    .replace('"%(color_index)d"', "%(color_index)d")
+    .replace('"%(canvas_index)d"', "%(canvas_index)d")
+)
+
+SET_PIXEL_HEADERS = {
+    "origin": "https://hot-potato.reddit.com",
+    "referer": "https://hot-potato.reddit.com/",
+    "apollographql-client-name": "mona-lisa",
+    "Content-Type": "application/json",
+}
+
+
+def get_endpoints(json_data):
+    endpoints = dict(DEFAULT_ENDPOINTS)
+    if "endpoints" in json_data and json_data["endpoints"] is not None:
+        unknown = set(json_data["endpoints"]) - set(DEFAULT_ENDPOINTS)
+        if unknown:
+            exit(
+                "Unknown endpoints: {}, expected some of: {}".format(
+                    ", ".join(sorted(unknown)), ", ".join(DEFAULT_ENDPOINTS)
+                )
+            )
+        endpoints.update(json_data["endpoints"])
+    return endpoints
+
+
+# Sessions are not guaranteed to be thread safe, so every thread keeps its own
+_local = threading.local()
+
+
+def get_session():
+    """Keep-alive session of the calling thread, connections are reused per host"""
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _local.session = session
+    return session
+
+
+def set_pixel(self, access_token, x, y, color_index, canvas_index):
+    """POST the setPixel mutation, returns the response and its decoded body"""
+    response = get_session().post(
+        self.endpoints["gql"],
+        headers={**SET_PIXEL_HEADERS, "Authorization": "Bearer " + access_token},
+        data=SET_PIXEL_PAYLOAD
+        % {"x": x, "y": y, "color_index": color_index, "canvas_index": canvas_index},
+        proxies=proxy.get_random_proxy(self),
+    )
+    return response, response.json()
+
+
+def download(self, url):
+    """Body of a canvas frame or any other static file"""
+    return get_session().get(url, proxies=proxy.get_random_proxy(self)).content
@@ -1,7 +1,15 @@
 import json
 import os
+from io import BytesIO
+
+import numpy as np
 from PIL import Image, UnidentifiedImageError
 
+from src.mappings import ColorMapper
+import src.cache as cache
+import src.quantize as quantize
+import src.template as template
+
 
 def get_json_data(self, config_path):
     configFilePath = os.path.join(os.getcwd(), config_path)
@@ -19,22 +27,282 @@ def get_json_data(self, config_path):
     # Read the input image.jpg file
 
 
-def load_image(self):
-    # Read and load the image to draw and get its dimensions
+def read_image_bytes(self, image_path):
     try:
-        im = Image.open(self.image_path)
+        with open(image_path, "rb") as f:
+            return f.read()
     except FileNotFoundError:
         self.logger.exception("Failed to load image")
         exit()
+
+
+def template_key(self, image_bytes):
+    """Everything the quantized template depends on"""
+    return cache.cache_key(
+        image_bytes,
+        self.rgb_colors_array,
+        self.color_metric,
+        self.dithering,
+        self.legacy_transparency,
+        ColorMapper.LUT_BITS,
+    )
+
+
+def quantize_image(self, image_bytes):
+    try:
+        im = Image.open(BytesIO(image_bytes))
     except UnidentifiedImageError:
         self.logger.exception("File found, but couldn't identify image format")
+        exit()
 
     # Convert all images to RGBA - Transparency should only be supported with PNG
     if im.mode != "RGBA":
         im = im.convert("RGBA")
         self.logger.info("Converted to rgba")
-    self.pix = im.load()
 
-    self.logger.info("Loaded image size: {}", im.size)
+    # Resolve every pixel to its palette index once instead of on every pass
+    self.logger.info("Quantizing image ({})", self.dithering)
+    return quantize.quantize(
+        im,
+        self.rgb_colors_array,
+        self.legacy_transparency,
+        self.dithering,
+        ColorMapper.load_lut(self.rgb_colors_array, self.color_metric, self.cache_dir),
+    )
+
+
+def get_template_specs(json_data):
+    """Templates to draw, the top level image_path when no templates list is given"""
+    if "templates" in json_data and json_data["templates"]:
+        templates = json_data["templates"]
+    else:
+        templates = [
+            {
+                "image_path": (
+                    json_data["image_path"]
+                    if "image_path" in json_data
+                    else "image.jpg"
+                ),
+                "image_start_coords": json_data["image_start_coords"],
+                "priority_mask": (
+                    json_data["priority_mask"] if "priority_mask" in json_data else None
+                ),
+            }
+        ]
+
+    specs = []
+    for template_data in templates:
+        priority = (
+            template_data["priority"]
+            if "priority" in template_data and template_data["priority"] is not None
+            else 0
+        )
+        if not 0 <= priority <= 255:
+            exit("Template priority must be between 0 and 255")
+        specs.append(
+            {
+                "image_path": template_data["image_path"],
+                "origin": tuple(template_data["image_start_coords"]),
+                "priority": priority,
+                # "alpha", a grayscale image of the same size or None
+                "priority_mask": (
+                    template_data["priority_mask"]
+                    if "priority_mask" in template_data
+                    else None
+                ),
+            }
+        )
+    return specs
+
+
+def get_template_settings(json_data):
+    """Options deciding how the images become templates"""
+    settings = {
+        "legacy_transparency": (
+            json_data["legacy_transparency"]
+            if "legacy_transparency" in json_data
+            and json_data["legacy_transparency"] is not None
+            else True
+        ),
+        "color_metric": (
+            json_data["color_metric"]
+            if "color_metric" in json_data and json_data["color_metric"] is not None
+            else "rgb"
+        ),
+        "dithering": (
+            json_data["dithering"]
+            if "dithering" in json_data and json_data["dithering"] is not None
+            else "nearest"
+        ),
+        "repair_strategy": (
+            json_data["repair_strategy"]
+            if "repair_strategy" in json_data
+            and json_data["repair_strategy"] is not None
+            else "raster"
+        ),
+    }
+    if settings["color_metric"] not in ColorMapper.COLOR_METRICS:
+        exit(
+            "color_metric must be one of: {}".format(
+                ", ".join(ColorMapper.COLOR_METRICS)
+            )
+        )
+    if settings["dithering"] not in quantize.DITHERING_METHODS:
+        exit(
+            "dithering must be one of: {}".format(", ".join(quantize.DITHERING_METHODS))
+        )
+    if settings["repair_strategy"] not in template.REPAIR_STRATEGIES:
+        exit(
+            "repair_strategy must be one of: {}".format(
+                ", ".join(template.REPAIR_STRATEGIES)
+            )
+        )
+    return settings
+
+
+def set_template_settings(self, settings):
+    self.legacy_transparency = settings["legacy_transparency"]
+    self.color_metric = settings["color_metric"]
+    self.dithering = settings["dithering"]
+    self.repair_strategy = settings["repair_strategy"]
+
+
+def load_image(self):
+    (
+        (self.pixel_x_start, self.pixel_y_start),
+        self.template_indices,
+        self.template_priority,
+        self.template_order,
+    ) = load_templates(self, self.template_specs, self.compiled_template_path)
+    self.image_size = (self.template_indices.shape[1], self.template_indices.shape[0])
+
+
+def load_templates(self, specs, compiled_template_path):
+    """(origin, palette indices, priority, drawing order) of the composited
+    templates, nothing on self changes"""
+    # A compiled template needs no decoding at all
+    if compiled_template_path is not None and os.path.exists(compiled_template_path):
+        return load_compiled_template(self, specs, compiled_template_path)
+
+    layers = []
+    for spec in specs:
+        indices = load_image_indices(self, spec["image_path"])
+        layers.append(
+            (
+                spec["origin"],
+                indices,
+                spec["priority"],
+                load_priority_mask(self, spec, indices.shape),
+            )
+        )
+    origin, indices, priority = template.composite(layers)
+    if len(specs) > 1:
+        self.logger.info(
+            "Composited {} templates into {}x{} at {}, {}",
+            len(specs),
+            indices.shape[1],
+            indices.shape[0],
+            origin[0],
+            origin[1],
+        )
+    order = template.repair_order(indices, priority, self.repair_strategy)
+    return origin, indices, priority, order
+
+
+def load_image_indices(self, image_path):
+    # Read and load the image to draw and get its dimensions
+    image_bytes = read_image_bytes(self, image_path)
+
+    # The same image quantized with the same options is reused from the cache
+    indices = cache.cached_array(
+        self.cache_dir,
+        "template-" + template_key(self, image_bytes),
+        lambda: quantize_image(self, image_bytes),
+    )
+
+    self.logger.info(
+        "Loaded image {} size: {}", image_path, (indices.shape[1], indices.shape[0])
+    )
+    return indices
+
+
+def load_priority_mask(self, spec, shape):
+    """[y, x] uint8 importance of every pixel of a template, higher is repaired sooner"""
+    if spec["priority_mask"] is None:
+        return None
+    if spec["priority_mask"] == "alpha":
+        image = Image.open(BytesIO(read_image_bytes(self, spec["image_path"])))
+        return np.asarray(image.convert("RGBA"))[..., 3]
+
+    try:
+        image = Image.open(BytesIO(read_image_bytes(self, spec["priority_mask"])))
+    except UnidentifiedImageError:
+        self.logger.exception("File found, but couldn't identify image format")
+        exit()
+    mask = np.asarray(image.convert("L"))
+    if mask.shape != shape:
+        exit(
+            "Priority mask {} must be the same size as {}".format(
+                spec["priority_mask"], spec["image_path"]
+            )
+        )
+    return mask
+
+
+def templates_key(self, specs):
+    """Everything a compiled template depends on, None if an image is missing"""
+    parts = [self.repair_strategy]
+    for spec in specs:
+        paths = [spec["image_path"]]
+        if spec["priority_mask"] not in (None, "alpha"):
+            paths.append(spec["priority_mask"])
+        for path in paths:
+            if not os.path.exists(path):
+                return None
+            with open(path, "rb") as f:
+                parts.append(template_key(self, f.read()))
+        parts += [spec["origin"], spec["priority"], spec["priority_mask"]]
+    return cache.cache_key(*parts)
+
+
+def compile_image(self, output_path):
+    """Composite and quantize the configured templates into a template artifact"""
+    origin, indices, priority, order = load_templates(self, self.template_specs, None)
+    template.write_template(
+        output_path,
+        origin,
+        indices,
+        templates_key(self, self.template_specs),
+        order=order,
+        priority=priority,
+    )
+    self.logger.info(
+        "Compiled {} templates ({}x{}) to {}",
+        len(self.template_specs),
+        indices.shape[1],
+        indices.shape[0],
+        output_path,
+    )
+
+
+def load_compiled_template(self, specs, compiled_template_path):
+    try:
+        compiled = template.read_template(compiled_template_path)
+    except (OSError, ValueError):
+        self.logger.exception("Failed to load compiled template")
+        exit()
+
+    # the images are only hashed, not decoded, to catch a forgotten recompile
+    key = templates_key(self, specs)
+    if key is not None and key != compiled.source_key:
+        self.logger.warning(
+            "Templates changed since {} was compiled, run compile again",
+            compiled_template_path,
+        )
 
-    self.image_size = im.size
+    self.logger.info(
+        "Loaded compiled template {} size: {}",
+        compiled_template_path,
+        (compiled.indices.shape[1], compiled.indices.shape[0]),
+    )
+    return compiled.origin, compiled.indices, compiled.priority, compiled.order